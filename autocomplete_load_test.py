@@ -0,0 +1,69 @@
+# autocomplete_load_test.py measures the requests/sec of the autocomplete endpoints with flask's test client,
+# replaying the keystrokes of users typing song names (so most requests are for 1-3 character prefixes).
+# it compares the html endpoint without the hot prefix cache (before), with it, and the json endpoint with ETag revalidation.
+# usage: python autocomplete_load_test.py [number_of_requests] [number_of_threads]
+import sys
+import time
+import random
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import song_recommender_app
+from trie import Trie
+
+def typed_prefixes(names: list[str], num_requests: int, seed: int = 0) -> list[str]:
+    """
+    Build the prefixes sent while users type song names, one request per keystroke.
+    Users usually pick a suggestion after a few characters, so each name is typed for 1 to 8 keystrokes.
+    """
+    rng = random.Random(seed)
+    prefixes: list[str] = []
+    while len(prefixes) < num_requests:
+        name = rng.choice(names)
+        num_keystrokes = rng.randint(1, 8)
+        prefixes.extend(name[:length] for length in range(1, min(num_keystrokes, len(name)) + 1))
+    return prefixes[:num_requests]
+
+def run_load(url: str, prefixes: list[str], num_threads: int, revalidate: bool = False) -> float:
+    """
+    Send a GET for every prefix from num_threads threads. Returns the requests/sec.
+    With revalidate=True, each thread remembers the ETag it got per prefix and sends it back like a browser cache would.
+    """
+    chunks = [prefixes[i::num_threads] for i in range(num_threads)]
+
+    def worker(chunk: list[str]) -> None:
+        client = song_recommender_app.app.test_client()
+        etags: dict[str, str] = {}
+        for prefix in chunk:
+            headers = {'If-None-Match': etags[prefix]} if revalidate and prefix in etags else {}
+            response = client.get(url, query_string={'prefix': prefix}, headers=headers)
+            if revalidate and response.headers.get('ETag'):
+                etags[prefix] = response.headers['ETag']
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        list(executor.map(worker, chunks))
+    return len(prefixes) / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    print('Building tries...')
+    data = pd.read_csv('./data/data.csv')[['name', 'artists']]
+    uncached_trie = Trie.from_list_of_names(data)
+    uncached_trie.hot_prefix_length = 0 # no hot prefix cache, like before
+    cached_trie = Trie.from_list_of_names(data)
+    prefixes = typed_prefixes(data['name'].astype(str).tolist(), num_requests)
+
+    results: list[tuple[str, float]] = []
+    song_recommender_app.trie = uncached_trie
+    results.append(('/autocomplete, no hot prefix cache (before)', run_load('/autocomplete', prefixes, num_threads)))
+    song_recommender_app.trie = cached_trie
+    results.append(('/autocomplete, hot prefix cache', run_load('/autocomplete', prefixes, num_threads)))
+    results.append(('/api/autocomplete', run_load('/api/autocomplete', prefixes, num_threads)))
+    results.append(('/api/autocomplete, ETag revalidation', run_load('/api/autocomplete', prefixes, num_threads, revalidate=True)))
+
+    print(f'\n{num_requests} requests, {num_threads} threads:')
+    baseline = results[0][1]
+    for name, requests_per_second in results:
+        print(f'{name:<45} {requests_per_second:10.0f} requests/sec ({requests_per_second / baseline:.1f}x)')
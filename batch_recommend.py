@@ -0,0 +1,241 @@
+# batch_recommend.py computes recommendations offline for a large file of seeds, without calling the Spotify API.
+# seeds are either Spotify track ids from data.csv (one per line), or a csv of raw feature vectors (one column per feature
+# in DATA_FEATURES, plus an optional 'seed' column to identify each row). they're read in blocks, normalized a block at
+# a time, and spread over a pool of worker processes running the KnnSongClassifier backends.
+# results are written in input order as they're done, to ndjson or to a directory of parquet files, and a checkpoint
+# is saved after every block so an interrupted run can pick up where it left off with --resume.
+# usage: python batch_recommend.py seeds.txt recommendations.ndjson [--k 5] [--metric euclidean] [--workers 8] [--resume]
+from __future__ import annotations
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import time
+import numpy as np
+import pandas as pd
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterator, Type
+from models.distance_metric import DistanceMetric
+from models.features import DATA_FEATURES
+from models.knn_song_classifier import KnnSongClassifier
+from models.my_k_neighbors_classifier import MyKNeighborsClassifier
+from neighbor_graph import init_worker, predict_block
+from song_catalog import SongCatalog
+from logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024
+REPORT_EVERY = 10 # blocks
+
+def read_id_blocks(path: str, catalog: SongCatalog, skip: int, block_size: int) -> Iterator[tuple[list[str], np.ndarray, np.ndarray]]:
+    """
+    Stream a file of Spotify track ids, one per line, as (seeds, normalized queries, exclude groups) blocks.
+    Seeds that are in the catalog use their catalog features, and skip their own duplicate group.
+    """
+    normalized, group_ids = catalog.normalized, catalog.group_ids
+    with open(path, 'r') as f:
+        seeds = (line.strip() for line in f if line.strip())
+        for _ in zip(range(skip), seeds):
+            pass
+        while True:
+            block = [seed for _, seed in zip(range(block_size), seeds)]
+            if not block:
+                return
+            rows = np.array([-1 if (row := catalog.row_for_id(seed)) is None else row for seed in block], dtype=np.int64)
+            found = rows >= 0
+            queries = np.full((len(block), normalized.shape[1]), np.nan)
+            queries[found] = normalized[rows[found]]
+            exclude_groups = np.where(found, group_ids[np.maximum(rows, 0)], -1)
+            yield block, queries, exclude_groups
+
+def read_feature_blocks(path: str, catalog: SongCatalog, skip: int, block_size: int) -> Iterator[tuple[list[str], np.ndarray, np.ndarray]]:
+    """
+    Stream a csv of raw feature vectors as (seeds, normalized queries, exclude groups) blocks.
+    The seed label is the 'seed' column if there is one, otherwise the row number.
+    """
+    reader = pd.read_csv(path, chunksize=block_size, skiprows=range(1, skip + 1))
+    seed_number = skip
+    for chunk in reader:
+        if 'seed' in chunk.columns:
+            seeds = chunk['seed'].astype(str).tolist()
+        else:
+            seeds = [str(seed_number + i) for i in range(len(chunk))]
+        seed_number += len(chunk)
+        queries = catalog.normalize(chunk[catalog.features].to_numpy(dtype=np.float64))
+        yield seeds, queries, np.full(len(chunk), -1)
+
+class BatchWriter:
+    """
+    Writes results in input order, either as ndjson (one line per seed) or as a directory of parquet files (one per block,
+    with one row per recommendation). Keeps a checkpoint of how many seeds are safely written.
+    """
+    def __init__(self, output: str, output_format: str, catalog: SongCatalog, resume: bool) -> None:
+        self.output = output
+        self.output_format = output_format
+        self.checkpoint_path = f'{output}.checkpoint.json'
+        self.ids = catalog.column('id')
+        self.names = catalog.column('name')
+        self.artists = catalog.column('artists')
+        self.blocks_done = 0
+        self.seeds_done = 0
+        self.output_bytes = 0
+
+        if resume and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as f:
+                checkpoint = json.load(f)
+            self.blocks_done = checkpoint['blocks_done']
+            self.seeds_done = checkpoint['seeds_done']
+            self.output_bytes = checkpoint['output_bytes']
+
+        if output_format == 'ndjson':
+            # drop anything written after the last checkpoint (a partially written block)
+            self._file = open(output, 'ab' if resume else 'wb')
+            self._file.truncate(self.output_bytes)
+            self._file.seek(self.output_bytes)
+        else:
+            os.makedirs(output, exist_ok=True)
+
+    def write(self, seeds: list[str], indices: np.ndarray, distances: np.ndarray) -> None:
+        """
+        Write one block of results, then checkpoint it.
+        """
+        if self.output_format == 'ndjson':
+            lines = []
+            for seed, seed_indices, seed_distances in zip(seeds, indices, distances):
+                found = seed_indices >= 0
+                recommendations = [
+                    {'id': self.ids[index], 'name': self.names[index], 'artists': self.artists[index], 'distance': float(distance)}
+                    for index, distance in zip(seed_indices[found], seed_distances[found])
+                ]
+                lines.append(json.dumps({'seed': seed, 'recommendations': recommendations}))
+            self._file.write(('\n'.join(lines) + '\n').encode())
+            self._file.flush()
+            self.output_bytes = self._file.tell()
+        else:
+            found = indices >= 0
+            flat_indices = indices[found]
+            pd.DataFrame({
+                'seed': np.repeat(np.array(seeds, dtype=object), found.sum(axis=1)),
+                'rank': np.nonzero(found)[1] + 1,
+                'id': self.ids[flat_indices],
+                'name': self.names[flat_indices],
+                'artists': self.artists[flat_indices],
+                'distance': distances[found],
+            }).to_parquet(os.path.join(self.output, f'part-{self.blocks_done:06d}.parquet'), index=False)
+
+        self.blocks_done += 1
+        self.seeds_done += len(seeds)
+        self._save_checkpoint()
+
+    def _save_checkpoint(self) -> None:
+        checkpoint = {'blocks_done': self.blocks_done, 'seeds_done': self.seeds_done, 'output_bytes': self.output_bytes}
+        with open(f'{self.checkpoint_path}.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(f'{self.checkpoint_path}.tmp', self.checkpoint_path)
+
+    def close(self) -> None:
+        if self.output_format == 'ndjson':
+            self._file.close()
+
+def run_batch(
+        input_path: str,
+        input_type: str,
+        output: str,
+        output_format: str,
+        catalog: SongCatalog,
+        k: int,
+        metric: DistanceMetric,
+        classifier: Type[KnnSongClassifier] = MyKNeighborsClassifier,
+        num_workers: int | None = None,
+        block_size: int = BLOCK_SIZE,
+        resume: bool = False
+    ) -> None:
+    """
+    Compute k recommendations for every seed in input_path and write them to output, reporting the throughput as it goes.
+    At most 2 blocks per worker are in flight at once, so memory use doesn't depend on the size of the input.
+    """
+    writer = BatchWriter(output, output_format, catalog, resume)
+    read_blocks = read_id_blocks if input_type == 'ids' else read_feature_blocks
+    blocks = read_blocks(input_path, catalog, writer.seeds_done, block_size)
+    if writer.seeds_done:
+        print(f'Resuming after {writer.seeds_done} seeds ({writer.blocks_done} blocks)')
+
+    start_time = time.perf_counter()
+    seeds_at_start = writer.seeds_done
+    num_not_found = 0
+
+    def report() -> None:
+        elapsed = time.perf_counter() - start_time
+        num_seeds = writer.seeds_done - seeds_at_start
+        print(f'{writer.seeds_done} seeds done, {num_seeds / elapsed:.0f} seeds/sec ({elapsed:.1f}s elapsed, {num_not_found} not found)')
+
+    num_workers = num_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=init_worker,
+        initargs=(np.ascontiguousarray(catalog.normalized), catalog.group_ids.copy(), classifier, metric, k)
+    ) as executor:
+        max_in_flight = 2 * num_workers
+        in_flight: deque[tuple[list[str], Future]] = deque()
+
+        def write_oldest() -> None:
+            nonlocal num_not_found
+            seeds, future = in_flight.popleft()
+            indices, distances = future.result()
+            num_not_found += int((indices[:, 0] < 0).sum())
+            writer.write(seeds, indices, distances)
+            if writer.blocks_done % REPORT_EVERY == 0:
+                report()
+
+        for seeds, queries, exclude_groups in blocks:
+            in_flight.append((seeds, executor.submit(predict_block, queries, exclude_groups, k)))
+            if len(in_flight) >= max_in_flight:
+                write_oldest()
+        while in_flight:
+            write_oldest()
+
+    writer.close()
+    report()
+    logger.info(f'run_batch({input_path=}, {output=}): done, {writer.seeds_done} seeds')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute song recommendations offline for a file of seeds.')
+    parser.add_argument('input', help='file of seeds: Spotify track ids (one per line) or a csv of feature vectors')
+    parser.add_argument('output', help='ndjson file, or directory of parquet files with --format parquet')
+    parser.add_argument('--input-type', choices=['ids', 'features'], default='ids')
+    parser.add_argument('--format', choices=['ndjson', 'parquet'], default='ndjson')
+    parser.add_argument('--data', default='./data/data.csv', help='the song dataset')
+    parser.add_argument('--k', type=int, default=5, help='number of recommendations per seed')
+    parser.add_argument('--metric', default='euclidean', choices=[metric.name.lower() for metric in DistanceMetric])
+    parser.add_argument('--gpu', action='store_true', help='use the CUDA classifier (use --workers 1 unless you have several GPUs)')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes, defaults to the number of CPUs')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE, help='number of seeds per block')
+    parser.add_argument('--resume', action='store_true', help='continue from the last checkpoint of this output')
+    args = parser.parse_args()
+    # pandas needs a parquet engine, check for one before loading the catalog rather than failing on the first block.
+    if args.format == 'parquet' and not any(importlib.util.find_spec(engine) for engine in ('pyarrow', 'fastparquet')):
+        parser.error('--format parquet needs pyarrow (pip install pyarrow)')
+
+    setup_logging()
+    classifier = MyKNeighborsClassifier
+    if args.gpu:
+        from models.gpu_kneighbors import GpuKNeighbors
+        classifier = GpuKNeighbors
+
+    catalog = SongCatalog(pd.read_csv(args.data), DATA_FEATURES)
+    run_batch(
+        input_path=args.input,
+        input_type=args.input_type,
+        output=args.output,
+        output_format=args.format,
+        catalog=catalog,
+        k=args.k,
+        metric=DistanceMetric[args.metric.upper()],
+        classifier=classifier,
+        num_workers=args.workers,
+        block_size=args.block_size,
+        resume=args.resume,
+    )
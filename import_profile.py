@@ -0,0 +1,57 @@
+# import_profile.py reports which modules take the longest to import when a module is loaded.
+# it runs the import in a fresh interpreter with python's `-X importtime` flag and summarizes the output.
+# usage: python import_profile.py [module_name] [number_of_rows]
+# by default it profiles song_recommender_app, which should only import flask and a few small modules.
+import subprocess
+import sys
+
+def profile_imports(module_name: str) -> list[tuple[int, int, int, str]]:
+    """
+    Import module_name in a fresh interpreter and return the modules it imported (directly or not),
+    as a list of (self_us, cumulative_us, depth, module) tuples. The last tuple is module_name itself, with depth 0.
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module_name}'],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f'Failed to import {module_name}:\n{result.stderr}')
+
+    timings = []
+    for line in result.stderr.splitlines():
+        # lines look like: "import time:       215 |        215 |   numpy.version", indented by 2 spaces per level.
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        timings.append((int(self_us), int(cumulative_us), depth, name.strip()))
+
+    # imports are reported after their children, so everything module_name imported comes right before it.
+    # the interpreter's own startup imports (site, encodings, ...) come earlier and end with a depth 0 entry.
+    end = max(i for i, timing in enumerate(timings) if timing[2] == 0 and timing[3] == module_name)
+    start = end
+    while start > 0 and timings[start - 1][2] > 0:
+        start -= 1
+    return timings[start:end + 1]
+
+def print_report(module_name: str, timings: list[tuple[int, int, int, str]], num_rows: int) -> None:
+    """
+    Print the total import time, then the slowest direct imports and the slowest individual modules.
+    """
+    total_us = timings[-1][1]
+    print(f'Importing {module_name} took {total_us / 1000:.1f} ms ({len(timings)} modules)\n')
+
+    direct_imports = [timing for timing in timings if timing[2] == 1]
+    print(f'Slowest direct imports of {module_name} (cumulative):')
+    for _, cumulative_us, _, name in sorted(direct_imports, key=lambda timing: timing[1], reverse=True)[:num_rows]:
+        print(f'{cumulative_us / 1000:10.1f} ms  {name}')
+
+    print('\nSlowest modules (self time):')
+    for self_us, _, _, name in sorted(timings, reverse=True)[:num_rows]:
+        print(f'{self_us / 1000:10.1f} ms  {name}')
+
+if __name__ == '__main__':
+    module_name = sys.argv[1] if len(sys.argv) > 1 else 'song_recommender_app'
+    num_rows = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    print_report(module_name, profile_imports(module_name), num_rows)
@@ -1,9 +1,78 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import random
+from typing import Any, Callable
+
+LOG_FILE = 'app.log'
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# set MUSIC_RECOMMENDER_LOG_LEVEL=DEBUG to log the debug dumps (classifier results, full song objects, etc).
+LOG_LEVEL = os.environ.get('MUSIC_RECOMMENDER_LOG_LEVEL', 'INFO').upper()
+# fraction of DEBUG records that are kept, so the debug dumps can stay on under load.
+DEBUG_SAMPLE_RATE = float(os.environ.get('MUSIC_RECOMMENDER_DEBUG_SAMPLE_RATE', '1.0'))
+
+_listener: logging.handlers.QueueListener | None = None
+
+class LazyFormat:
+    """
+    Defers an expensive computation until a log record is actually formatted, like:
+        logger.debug('songs: %s', LazyFormat(json.dumps, songs, indent=4))
+    If the record is dropped (level or sampling), func is never called.
+    """
+    def __init__(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> None:
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        return str(self.func(*self.args, **self.kwargs))
+
+class DebugSampler(logging.Filter):
+    """
+    Keeps every record above DEBUG, and a random `rate` fraction of the DEBUG records.
+    """
+    def __init__(self, rate: float) -> None:
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    A QueueHandler that leaves the record untouched. The default one formats the message on the calling thread,
+    but our queue never leaves the process, so the listener thread can do the formatting instead.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
 
 def setup_logging() -> None:
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S',
-        filename='app.log',
-    )
+    """
+    Configure logging for the app. Only the entry points (the flask app and the scripts) call this,
+    so importing a module never touches the logging setup. Calling it more than once does nothing.
+
+    Records are put on a queue by the calling thread, and a background QueueListener formats them and writes them to
+    app.log, so request threads never format messages or do file I/O for logging.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(DEBUG_SAMPLE_RATE))
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(LOG_LEVEL)
+    root_logger.addHandler(queue_handler)
+
+    _listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop) # flush the queue on exit
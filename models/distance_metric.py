@@ -3,6 +3,10 @@ from enum import Enum, auto
 class DistanceMetric(Enum):
     """
     Represents all available distance metrics for the SongClassifiers.
+    The distance functions themselves are registered in metric_registry.py.
     """
     EUCLIDEAN = auto()
-    MANHATTAN = auto()
\ No newline at end of file
+    MANHATTAN = auto()
+    COSINE = auto()
+    WEIGHTED_EUCLIDEAN = auto()
+    MINKOWSKI = auto()
\ No newline at end of file
@@ -0,0 +1,7 @@
+# the song features the classifiers work with, in the column order of the catalog's feature matrix.
+DATA_FEATURES = ['valence', 'acousticness', 'danceability', 'energy', 
+                 'instrumentalness', 'liveness', 'loudness', 'speechiness', 'tempo']
+
+# weights for DistanceMetric.WEIGHTED_EUCLIDEAN, favoring the mood of a song over how it was recorded.
+FEATURE_WEIGHTS = {'valence': 1.5, 'acousticness': 1.0, 'danceability': 1.5, 'energy': 1.5, 
+                   'instrumentalness': 1.0, 'liveness': 0.5, 'loudness': 0.5, 'speechiness': 1.0, 'tempo': 0.75}
@@ -1,10 +1,56 @@
 import numpy as np
 from abc import ABC, abstractmethod
+from typing import Collection
 from .distance_metric import DistanceMetric
 
+def select_k_nearest(
+        distances: np.ndarray, 
+        k: int, 
+        groups: np.ndarray | None = None, 
+        exclude_groups: Collection[int] = ()
+    ) -> np.ndarray:
+    """
+    Return the indices of the k smallest distances, closest first.
+
+    If groups is given (a group label per point), at most one point per group is returned, and points in exclude_groups
+    are skipped, so the result has exactly k distinct groups whenever the dataset has that many.
+    Only a small candidate set is sorted, and it's doubled until k distinct groups are found.
+    Points with non-finite distances are never returned in that case.
+    """
+    if groups is None:
+        return np.argsort(distances)[:k]
+
+    num_points = len(distances)
+    if k <= 0 or num_points == 0:
+        return np.empty(0, dtype=np.int64)
+    num_candidates = min(num_points, 2 * k)
+    while True:
+        if num_candidates < num_points:
+            candidates = np.argpartition(distances, num_candidates - 1)[:num_candidates]
+        else:
+            candidates = np.arange(num_points)
+        candidates = candidates[np.argsort(distances[candidates], kind='stable')]
+
+        selected: list[int] = []
+        seen_groups = set(exclude_groups)
+        for index in candidates:
+            if not np.isfinite(distances[index]):
+                break
+            if groups[index] in seen_groups:
+                continue
+            seen_groups.add(groups[index])
+            selected.append(index)
+            if len(selected) == k:
+                return np.array(selected, dtype=np.int64)
+
+        if num_candidates == num_points or not np.isfinite(distances[candidates[-1]]):
+            return np.array(selected, dtype=np.int64)
+        num_candidates = min(num_points, num_candidates * 2)
+
 class KnnSongClassifier(ABC):
     """
     Abstract class for any knn-based song classifier.
+    fit() optionally takes y, a group label per song. When it's given, predict() returns at most one song per group.
     """
     @abstractmethod
     def __init__(self, k: int, dist_metric: DistanceMetric) -> None:
@@ -15,5 +61,5 @@ class KnnSongClassifier(ABC):
         raise NotImplementedError
     
     @abstractmethod
-    def predict(self, query: np.ndarray) -> tuple[list[float], list[int]]:
+    def predict(self, query: np.ndarray, exclude_groups: Collection[int] = ()) -> tuple[list[float], list[int]]:
         raise NotImplementedError
\ No newline at end of file
@@ -0,0 +1,206 @@
+import hashlib
+import math
+import numpy as np
+from dataclasses import dataclass
+from typing import Any, Callable, Sequence
+from .distance_metric import DistanceMetric
+from .features import DATA_FEATURES, FEATURE_WEIGHTS
+
+THREADS_PER_BLOCK = 256
+
+# A point distance function has the signature (query, point, num_features) -> float.
+# It must only use scalar loops and the math module, so numba can compile it for both the CPU and the GPU.
+PointDistance = Callable[[np.ndarray, np.ndarray, int], float]
+
+def euclidean(query: np.ndarray, point: np.ndarray, num_features: int) -> float:
+    """
+    Euclidean distance between query and point.
+    """
+    total = 0.0
+    for i in range(num_features):
+        diff = query[i] - point[i]
+        total += diff * diff
+    return math.sqrt(total)
+
+def manhattan(query: np.ndarray, point: np.ndarray, num_features: int) -> float:
+    """
+    Manhattan distance between query and point.
+    """
+    total = 0.0
+    for i in range(num_features):
+        total += math.fabs(query[i] - point[i])
+    return total
+
+def cosine(query: np.ndarray, point: np.ndarray, num_features: int) -> float:
+    """
+    Cosine distance (1 - cosine similarity) between query and point. The zero vector is at distance 1 from everything.
+    """
+    dot = 0.0
+    query_norm = 0.0
+    point_norm = 0.0
+    for i in range(num_features):
+        dot += query[i] * point[i]
+        query_norm += query[i] * query[i]
+        point_norm += point[i] * point[i]
+    denominator = math.sqrt(query_norm) * math.sqrt(point_norm)
+    if denominator == 0.0:
+        return 1.0
+    return 1.0 - dot / denominator
+
+def weighted_euclidean(weights: Sequence[float]) -> PointDistance:
+    """
+    Returns a euclidean distance function where each feature's squared difference is scaled by its weight.
+    The weights are baked into the compiled kernels as constants.
+    """
+    feature_weights = np.asarray(weights, dtype=np.float64)
+
+    def _weighted_euclidean(query: np.ndarray, point: np.ndarray, num_features: int) -> float:
+        total = 0.0
+        for i in range(num_features):
+            diff = query[i] - point[i]
+            total += feature_weights[i] * diff * diff
+        return math.sqrt(total)
+    return _weighted_euclidean
+
+def minkowski(p: float) -> PointDistance:
+    """
+    Returns a Minkowski distance function of order p. The order is baked into the compiled kernels as a constant.
+    """
+    if p < 1:
+        raise ValueError(f'Minkowski distance needs p >= 1, got {p}')
+    order = float(p)
+    inverse_order = 1.0 / order
+
+    def _minkowski(query: np.ndarray, point: np.ndarray, num_features: int) -> float:
+        total = 0.0
+        for i in range(num_features):
+            total += math.fabs(query[i] - point[i]) ** order
+        return total ** inverse_order
+    return _minkowski
+
+@dataclass
+class RegisteredMetric:
+    """
+    A distance metric and its compiled kernels. The kernels are compiled on first use, or by warm_up().
+    """
+    point_distance: PointDistance
+    cpu_kernel: Any = None
+    gpu_kernel: Any = None
+
+_registry: dict[DistanceMetric, RegisteredMetric] = {}
+
+def register_metric(metric: DistanceMetric, point_distance: PointDistance) -> None:
+    """
+    Register (or replace) the point distance function used for this metric by every classifier.
+    """
+    _registry[metric] = RegisteredMetric(point_distance)
+
+def registered_metrics() -> list[DistanceMetric]:
+    return list(_registry)
+
+def get_point_distance(metric: DistanceMetric) -> PointDistance:
+    """
+    Returns the plain python point distance function for this metric.
+    """
+    return _get_registered_metric(metric).point_distance
+
+def metric_signature(metric: DistanceMetric) -> str:
+    """
+    Returns a hash of the point distance function registered for this metric: its name, its code and the values it
+    captured (like the weights of weighted_euclidean() or the p of minkowski()). Results computed with a metric,
+    like the neighbor graphs, are only valid while the signature is the same.
+    The bytecode is part of the hash, so it also changes with the Python version.
+    """
+    point_distance = _get_registered_metric(metric).point_distance
+    code = point_distance.__code__
+    captured = [np.asarray(cell.cell_contents).tolist() for cell in point_distance.__closure__ or ()]
+    digest = hashlib.sha256()
+    digest.update(f'{point_distance.__module__}.{point_distance.__qualname__}'.encode())
+    digest.update(code.co_code)
+    digest.update(repr((code.co_consts, code.co_names, captured)).encode())
+    return digest.hexdigest()
+
+def get_cpu_kernel(metric: DistanceMetric) -> Callable[[np.ndarray, np.ndarray, np.ndarray], None]:
+    """
+    Returns the JIT compiled CPU kernel for this metric, with signature (data, query, distances) -> None.
+    It fills distances[i] with the distance from query to data[i].
+    """
+    registered_metric = _get_registered_metric(metric)
+    if registered_metric.cpu_kernel is None:
+        registered_metric.cpu_kernel = _build_cpu_kernel(registered_metric.point_distance)
+    return registered_metric.cpu_kernel
+
+def get_gpu_kernel(metric: DistanceMetric) -> Any:
+    """
+    Returns the CUDA kernel for this metric, with signature (data, distances, query, num_songs, num_features) -> None.
+    - data: the dataset, flattened
+    - distances: output array for distances
+    - query: the record we want k neighbors for
+    - num_songs: number of songs in the dataset
+    - num_features: number of features per song
+    """
+    registered_metric = _get_registered_metric(metric)
+    if registered_metric.gpu_kernel is None:
+        registered_metric.gpu_kernel = _build_gpu_kernel(registered_metric.point_distance)
+    return registered_metric.gpu_kernel
+
+def warm_up(num_features: int, gpu: bool = False) -> None:
+    """
+    Compile every registered metric's kernels ahead of time by running them on a tiny dataset,
+    so the first real request doesn't pay for the compilation.
+    The dummy arrays have the same types and layouts as the real ones, so the same specialization is reused.
+    """
+    data = np.zeros((2, num_features), dtype=np.float64)
+    query = np.zeros(num_features, dtype=np.float64)
+    distances = np.empty(len(data), dtype=np.float64)
+    for metric in registered_metrics():
+        get_cpu_kernel(metric)(data, query, distances)
+
+    if gpu:
+        from numba import cuda
+        d_data = cuda.to_device(data.ravel())
+        d_query = cuda.to_device(query)
+        d_distances = cuda.device_array(len(data), dtype=np.float64)
+        for metric in registered_metrics():
+            get_gpu_kernel(metric)[1, THREADS_PER_BLOCK](d_data, d_distances, d_query, len(data), num_features)
+        cuda.synchronize()
+
+def _get_registered_metric(metric: DistanceMetric) -> RegisteredMetric:
+    if metric not in _registry:
+        raise ValueError(f'Unsupported distance metric: {metric}')
+    return _registry[metric]
+
+def _build_cpu_kernel(point_distance: PointDistance) -> Callable:
+    """
+    Compile a CPU kernel specialized for point_distance, so the inner loop has no metric dispatch.
+    """
+    from numba import njit
+    distance = njit(point_distance)
+
+    @njit
+    def kernel(data: np.ndarray, query: np.ndarray, distances: np.ndarray) -> None:
+        num_features = data.shape[1]
+        for i in range(data.shape[0]):
+            distances[i] = distance(query, data[i], num_features)
+    return kernel
+
+def _build_gpu_kernel(point_distance: PointDistance) -> Any:
+    """
+    Compile a CUDA kernel specialized for point_distance, so the kernel has no metric dispatch.
+    """
+    from numba import cuda
+    distance = cuda.jit(device=True)(point_distance)
+
+    @cuda.jit
+    def kernel(data, distances, query, num_songs, num_features) -> None:
+        idx = cuda.grid(1)
+        if idx < num_songs:
+            point = data[idx * num_features : (idx + 1) * num_features]
+            distances[idx] = distance(query, point, num_features)
+    return kernel
+
+register_metric(DistanceMetric.EUCLIDEAN, euclidean)
+register_metric(DistanceMetric.MANHATTAN, manhattan)
+register_metric(DistanceMetric.COSINE, cosine)
+register_metric(DistanceMetric.WEIGHTED_EUCLIDEAN, weighted_euclidean([FEATURE_WEIGHTS[f] for f in DATA_FEATURES]))
+register_metric(DistanceMetric.MINKOWSKI, minkowski(3))
@@ -1,22 +1,8 @@
 import numpy as np
-from typing import Any
-from numba import jit, float64
+from typing import Any, Collection
 from .distance_metric import DistanceMetric
-from .knn_song_classifier import KnnSongClassifier
-
-@jit(float64(float64[:], float64[:]), nopython=True, cache=True)
-def _jit_euclidean(query: np.ndarray, point: np.ndarray) -> float:
-    """
-    Just in time compiled version of euclidean distance calculation.
-    """
-    return np.sqrt(np.sum((query - point) ** 2))
-
-@jit(float64(float64[:], float64[:]), nopython=True, cache=True)
-def _jit_manhattan(query: np.ndarray, point: np.ndarray) -> float:
-    """
-    Just in time compiled version of manhattan distance calculation.
-    """
-    return np.sum(np.abs(query - point))
+from .knn_song_classifier import KnnSongClassifier, select_k_nearest
+from .metric_registry import get_cpu_kernel, get_point_distance
 
 class MyKNeighborsClassifier(KnnSongClassifier):
     def __init__(
@@ -61,31 +47,37 @@ class MyKNeighborsClassifier(KnnSongClassifier):
 
     def fit(self, X: np.ndarray, y: Any = None) -> None:
         """
-        Fit this KNN classifier with the data.
+        Fit this KNN classifier with the data. y is an optional group label per row (see KnnSongClassifier).
         """
         self.X = X
         self.y = y
 
-    def predict(self, query: np.ndarray) -> tuple[list[float], list[int]]:
+    def predict(self, query: np.ndarray, exclude_groups: Collection[int] = ()) -> tuple[list[float], list[int]]:
         """
         Find the k nearest neighbors. Compare a single query point to every point in the dataset.
 
         Params:
             - query (np.ndarray): the point we want the k neighbors for (the song the user input).
+            - exclude_groups (Collection[int]): groups to skip, like the query's own group. Only used if fit() got y.
 
         Returns:
             - tuple(distances, indices) for the k neighbors for each point.
         """
-        if self.dist_metric is DistanceMetric.EUCLIDEAN:
-            distance_func = _jit_euclidean if self.jit_compilation else self._euclidean
-        elif self.dist_metric is DistanceMetric.MANHATTAN:
-            distance_func = _jit_manhattan if self.jit_compilation else self._manhattan
+        if self.jit_compilation:
+            # the registry's kernel is compiled for this metric only, and loops over the whole dataset in one call.
+            distances = np.empty(len(self.X), dtype=np.float64)
+            get_cpu_kernel(self.dist_metric)(self.X, query, distances)
         else:
-            raise ValueError(f'Unsupported distance metric: {self.dist_metric}')
-
-        distances = np.array([distance_func(query, point) for point in self.X])
+            if self.dist_metric is DistanceMetric.EUCLIDEAN:
+                distance_func = self._euclidean
+            elif self.dist_metric is DistanceMetric.MANHATTAN:
+                distance_func = self._manhattan
+            else:
+                point_distance = get_point_distance(self.dist_metric)
+                distance_func = lambda query, point: point_distance(query, point, len(point))
+            distances = np.array([distance_func(query, point) for point in self.X])
 
-        # find indices of k smallest distances
-        indices = np.argsort(distances)[:self.k]
+        # find indices of k smallest distances, one per group if we have groups
+        indices = select_k_nearest(distances, self.k, self.y, exclude_groups)
         return distances[indices], indices
     
\ No newline at end of file
@@ -0,0 +1,287 @@
+# neighbor_graph.py precomputes the k nearest neighbors of every song in data.csv, for each distance metric.
+# the graph is saved as .npy files (int32 indices, float32 distances) that the app memory-maps,
+# so recommendations for songs that are already in the catalog are a lookup instead of a scan of the whole dataset.
+# songs added to the catalog after the build are scanned per request and merged in, so the graph only needs a rebuild
+# when the normalization bounds move.
+# usage: python neighbor_graph.py [output_dir] [k] [num_workers]
+from __future__ import annotations
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Type
+from models.distance_metric import DistanceMetric
+from models.knn_song_classifier import KnnSongClassifier
+from models.metric_registry import get_cpu_kernel, metric_signature, registered_metrics
+from models.my_k_neighbors_classifier import MyKNeighborsClassifier
+from song_catalog import SongCatalog
+from logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GRAPH_DIR = './data/neighbor_graph'
+DEFAULT_K = 20 # more than the app shows, so there's room to skip songs retired after the build
+BLOCK_SIZE = 512
+
+def ids_fingerprint(ids: np.ndarray) -> str:
+    """
+    A hash of the song ids in row order. A graph is only used with a catalog whose first rows have the same fingerprint,
+    so editing, reordering or removing rows of data.csv never makes the graph serve the wrong songs.
+    """
+    return hashlib.sha256('\n'.join(map(str, ids)).encode()).hexdigest()
+
+class NeighborGraph:
+    """
+    The precomputed nearest neighbors of every catalog song for one distance metric.
+    Row i of indices/distances holds the neighbors of catalog row i, closest first, with at most one song per duplicate group
+    and none from the song's own group.
+    """
+    def __init__(
+            self,
+            metric: DistanceMetric,
+            indices: np.ndarray,
+            distances: np.ndarray,
+            features: list[str],
+            bounds: tuple[np.ndarray, np.ndarray],
+            fingerprint: str | None,
+            signature: str | None
+        ) -> None:
+        self.metric = metric
+        self.indices = indices
+        self.distances = distances
+        self.features = features
+        self.bounds = bounds
+        self.fingerprint = fingerprint
+        self.signature = signature
+
+    @property
+    def num_songs(self) -> int:
+        return self.indices.shape[0]
+
+    @property
+    def k(self) -> int:
+        return self.indices.shape[1]
+
+    @staticmethod
+    def _paths(directory: str, metric: DistanceMetric) -> tuple[str, str, str]:
+        """
+        Returns the (indices, distances, metadata) file paths for this metric's graph.
+        """
+        name = metric.name.lower()
+        return (
+            os.path.join(directory, f'{name}_indices.npy'),
+            os.path.join(directory, f'{name}_distances.npy'),
+            os.path.join(directory, f'{name}.json'),
+        )
+
+    @classmethod
+    def load(cls, directory: str, metric: DistanceMetric) -> NeighborGraph | None:
+        """
+        Memory-map the graph for this metric from directory. Returns None if it hasn't been built.
+        """
+        indices_path, distances_path, metadata_path = cls._paths(directory, metric)
+        if not all(os.path.exists(path) for path in (indices_path, distances_path, metadata_path)):
+            return None
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+        return cls(
+            metric=metric,
+            indices=np.load(indices_path, mmap_mode='r'),
+            distances=np.load(distances_path, mmap_mode='r'),
+            features=metadata['features'],
+            bounds=(np.array(metadata['min']), np.array(metadata['max'])),
+            fingerprint=metadata.get('ids_fingerprint'), # graphs built before the fingerprint was added are never used
+            signature=metadata.get('metric_signature'),
+        )
+
+    @classmethod
+    def load_all(cls, directory: str, catalog: SongCatalog) -> dict[DistanceMetric, NeighborGraph]:
+        """
+        Load the graphs of every registered metric that were built with the catalog's features and the metric's current
+        distance function, from the same songs in the same order as the first rows of the catalog.
+        """
+        graphs = {}
+        catalog_ids = catalog.column('id')
+        fingerprints: dict[int, str] = {} # by number of songs, the graphs are usually the same size
+        for metric in registered_metrics():
+            graph = cls.load(directory, metric)
+            if graph is None:
+                continue
+            if graph.features != catalog.features:
+                logger.warning(f'Ignoring neighbor graph for {metric}, it was built with features {graph.features}')
+                continue
+            if graph.signature != metric_signature(metric):
+                logger.warning(f'Ignoring neighbor graph for {metric}, it was built with a different distance function (weights, p, etc)')
+                continue
+            if graph.num_songs > len(catalog_ids):
+                logger.warning(f'Ignoring neighbor graph for {metric}, it has more songs than the catalog')
+                continue
+            if graph.num_songs not in fingerprints:
+                fingerprints[graph.num_songs] = ids_fingerprint(catalog_ids[:graph.num_songs])
+            if graph.fingerprint != fingerprints[graph.num_songs]:
+                logger.warning(f'Ignoring neighbor graph for {metric}, it was built from different songs than the catalog')
+                continue
+            graphs[metric] = graph
+        logger.info(f'Loaded neighbor graphs for {[metric.name for metric in graphs]} from {directory}')
+        return graphs
+
+    def is_current(self, catalog: SongCatalog) -> bool:
+        """
+        Whether the graph still matches the catalog. If songs added since the graph was built moved the normalization
+        bounds, every normalized feature changed and the precomputed distances can't be trusted anymore.
+        The rows themselves are checked once by load_all(), since catalog rows never move.
+        """
+        catalog_min, catalog_max = catalog.bounds
+        return (
+            self.num_songs <= len(catalog)
+            and np.array_equal(self.bounds[0], catalog_min)
+            and np.array_equal(self.bounds[1], catalog_max)
+        )
+
+    def neighbors(self, row: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (distances, indices) of the precomputed neighbors of this catalog row, closest first.
+        Rows that were retired when the graph was built have no neighbors.
+        """
+        indices = np.asarray(self.indices[row], dtype=np.int64)
+        distances = np.asarray(self.distances[row], dtype=np.float64)
+        found = indices >= 0
+        return distances[found], indices[found]
+
+    def added_song_distances(self, catalog: SongCatalog, row: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (distances, indices) from this catalog row to every song added to the catalog after the graph was built,
+        unsorted, to be merged with neighbors(). Only the added rows are scanned, so the cost is proportional to the change.
+        Retired songs have infinite distance.
+        """
+        normalized = catalog.normalized
+        added = normalized[self.num_songs:]
+        distances = np.empty(len(added), dtype=np.float64)
+        if len(added):
+            get_cpu_kernel(self.metric)(added, normalized[row], distances)
+        return distances, np.arange(self.num_songs, len(normalized))
+
+# the worker processes keep their own fitted classifier, so the dataset is only sent to each worker once.
+# batch_recommend.py runs its pool with the same init_worker() and predict_block().
+_worker_classifier: KnnSongClassifier | None = None
+_worker_data: np.ndarray | None = None
+_worker_groups: np.ndarray | None = None
+
+def init_worker(
+        normalized: np.ndarray, 
+        groups: np.ndarray, 
+        classifier: Type[KnnSongClassifier], 
+        metric: DistanceMetric, 
+        k: int
+    ) -> None:
+    """
+    ProcessPoolExecutor initializer: fit a classifier on the normalized catalog in this worker process.
+    """
+    global _worker_classifier, _worker_data, _worker_groups
+    _worker_data = normalized
+    _worker_groups = groups
+    _worker_classifier = classifier(k, metric)
+    _worker_classifier.fit(normalized, groups)
+
+def predict_block(queries: np.ndarray, exclude_groups: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the k nearest neighbors (one per duplicate group) of every normalized query in the block with this worker's
+    classifier. exclude_groups holds the group each query must skip, or -1 for none. Queries with non-finite features
+    (retired songs, seeds that weren't found) get no neighbors.
+    Returns (indices, distances), padded with -1 and inf.
+    """
+    indices = np.full((len(queries), k), -1, dtype=np.int32)
+    distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+    for i, (query, exclude_group) in enumerate(zip(queries, exclude_groups)):
+        if not np.isfinite(query).all():
+            continue
+        query_distances, query_indices = _worker_classifier.predict(
+            np.ascontiguousarray(query), exclude_groups=() if exclude_group < 0 else {int(exclude_group)}
+        )
+        indices[i, :len(query_indices)] = query_indices
+        distances[i, :len(query_distances)] = query_distances
+    return indices, distances
+
+def _neighbors_for_block(start: int, stop: int, k: int) -> tuple[int, np.ndarray, np.ndarray]:
+    """
+    Find the k nearest neighbors (excluding its own group) of every catalog row in [start, stop).
+    Returns (start, indices, distances) so the caller knows where to write the block.
+    """
+    indices, distances = predict_block(_worker_data[start:stop], _worker_groups[start:stop], k)
+    return start, indices, distances
+
+def build_neighbor_graph(
+        catalog: SongCatalog,
+        metric: DistanceMetric,
+        directory: str,
+        k: int = DEFAULT_K,
+        classifier: Type[KnnSongClassifier] = MyKNeighborsClassifier,
+        num_workers: int | None = None
+    ) -> NeighborGraph:
+    """
+    Compute the k nearest neighbors of every catalog song with the given metric and classifier,
+    splitting the catalog into blocks of rows that are processed in parallel by a pool of worker processes.
+    Each block is written to the memory-mapped output files as soon as it's done.
+    """
+    os.makedirs(directory, exist_ok=True)
+    indices_path, distances_path, metadata_path = NeighborGraph._paths(directory, metric)
+    # the metadata is written last, so a graph that's being rebuilt (or whose build was interrupted) is never loaded.
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+    # write to temporary files and swap them in at the end, since a running app may have the old graph memory-mapped.
+    num_songs = len(catalog)
+    indices = np.lib.format.open_memmap(f'{indices_path}.tmp', mode='w+', dtype=np.int32, shape=(num_songs, k))
+    distances = np.lib.format.open_memmap(f'{distances_path}.tmp', mode='w+', dtype=np.float32, shape=(num_songs, k))
+
+    start_time = time.perf_counter()
+    normalized = np.ascontiguousarray(catalog.normalized)
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        initializer=init_worker,
+        initargs=(normalized, catalog.group_ids.copy(), classifier, metric, k)
+    ) as executor:
+        futures = [
+            executor.submit(_neighbors_for_block, start, min(start + BLOCK_SIZE, num_songs), k)
+            for start in range(0, num_songs, BLOCK_SIZE)
+        ]
+        for num_done, future in enumerate(as_completed(futures), start=1):
+            start, block_indices, block_distances = future.result()
+            indices[start:start + len(block_indices)] = block_indices
+            distances[start:start + len(block_distances)] = block_distances
+            if num_done % 20 == 0 or num_done == len(futures):
+                print(f'{metric.name}: {num_done}/{len(futures)} blocks done ({time.perf_counter() - start_time:.1f}s)')
+    indices.flush()
+    distances.flush()
+    del indices, distances
+    os.replace(f'{indices_path}.tmp', indices_path)
+    os.replace(f'{distances_path}.tmp', distances_path)
+
+    catalog_min, catalog_max = catalog.bounds
+    with open(metadata_path, 'w') as f:
+        json.dump({
+            'features': catalog.features,
+            'min': catalog_min.tolist(),
+            'max': catalog_max.tolist(),
+            'ids_fingerprint': ids_fingerprint(catalog.column('id')[:num_songs]),
+            'metric_signature': metric_signature(metric),
+        }, f)
+
+    logger.info(f'Built neighbor graph for {metric} with {num_songs} songs and k={k} in {time.perf_counter() - start_time:.1f}s')
+    return NeighborGraph.load(directory, metric)
+
+# build the graph for every registered metric
+if __name__ == '__main__':
+    import pandas as pd
+    from models.features import DATA_FEATURES
+    setup_logging()
+    output_dir = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_GRAPH_DIR
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_K
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    catalog = SongCatalog(pd.read_csv('./data/data.csv'), DATA_FEATURES)
+    for metric in registered_metrics():
+        build_neighbor_graph(catalog, metric, output_dir, k=k, num_workers=num_workers)
@@ -1,26 +1,22 @@
-import ast
 import logging
 import json
+import threading
 import numpy as np
 import pandas as pd
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Type
-from sklearn.preprocessing import MinMaxScaler
 from spotify_manager import SpotifyManager
+from spotify_scheduler import Priority
 from models.my_k_neighbors_classifier import MyKNeighborsClassifier
-try:
-    from models.gpu_kneighbors import GpuKNeighbors
-except Exception as e:
-    pass
-from models.knn_song_classifier import KnnSongClassifier
+from models.knn_song_classifier import KnnSongClassifier, select_k_nearest
 from models.distance_metric import DistanceMetric
-from logging_config import setup_logging
+from models.features import DATA_FEATURES
+from logging_config import LazyFormat, setup_logging
 from song import Song
+from song_catalog import SongCatalog, primary_artist
+from neighbor_graph import NeighborGraph
+from trie import Trie
 
-DATA_FEATURES = ['valence', 'acousticness', 'danceability', 'energy', 
-                 'instrumentalness', 'liveness', 'loudness', 'speechiness', 'tempo']
-
-setup_logging()
 logger = logging.getLogger(__name__)
 
 class RecommendationsManager:
@@ -31,50 +27,84 @@ class RecommendationsManager:
             features: list[str], 
             spotify_manager: SpotifyManager, 
             classifier: Type[KnnSongClassifier], 
-            dist_metric: DistanceMetric = DistanceMetric.EUCLIDEAN
+            dist_metric: DistanceMetric = DistanceMetric.EUCLIDEAN,
+            trie: Trie | None = None,
+            neighbor_graph_dir: str | None = None
         ) -> None:
         """
         Initialize this RecommendationsManager. Provide the pd.DataFrame, the list of features to use for the classification,
         the type of classifier (unitialized class), and the distance metric to use with the classifier. 
         An initialized SpotifyManager must be passed to resolve the recommendations' album arts and spotify urls.
+        If a trie is passed, it's kept in sync with the songs added or retired through this manager.
+        If neighbor_graph_dir is passed, the graphs built by neighbor_graph.py are used to serve songs that are in the catalog.
         """
-        self.data = data
+        self.catalog = SongCatalog(data, features)
         self.features = features
         self.spotify_manager = spotify_manager
         self.classifier = classifier # classifier should be uninitialized here.
         self.dist_metric = dist_metric
-        
-    def _normalize_data(self, numerical_only_data: pd.DataFrame) -> np.ndarray:
+        self.trie = trie
+        self._catalog_lock = threading.Lock() # keeps catalog and trie updates together, reads use the catalog's published state
+        self.neighbor_graphs: dict[DistanceMetric, NeighborGraph] = (
+            NeighborGraph.load_all(neighbor_graph_dir, self.catalog) if neighbor_graph_dir is not None else {}
+        )
+
+    @property
+    def data(self) -> pd.DataFrame:
+        return self.catalog.data
+
+    def add_songs(self, new_songs: pd.DataFrame) -> None:
         """
-        Returns a numpy array where each feature of the df is scaled between 0 and 1.
-        The input dataframe must only contain numerical features.
+        Add new songs (a dataframe shaped like data.csv) to the live catalog, and to the trie if we have one.
+        Songs whose id is already in the catalog replace the old entry.
         """
-        scaler = MinMaxScaler()
-        normalized_data = scaler.fit_transform(numerical_only_data)
-        return normalized_data
-    
-    def _convert_df_to_songs(self, recommended_songs: pd.DataFrame, query_name: str) -> list[Song]:
+        with self._catalog_lock:
+            if 'id' in new_songs.columns:
+                self._retire_songs([song_id for song_id in new_songs['id'] if self.catalog.row_for_id(song_id) is not None])
+
+            self.catalog.add_songs(new_songs)
+            if self.trie is not None:
+                for track_name, artists in zip(new_songs['name'], new_songs['artists']):
+                    self.trie.insert_song(track_name, artists)
+        logger.info(f'add_songs(): added {len(new_songs)} songs, catalog has {self.catalog.num_active} active songs')
+
+    def retire_songs(self, song_ids: list[str]) -> None:
+        """
+        Retire the songs with these Spotify track ids, so they're no longer recommended or autocompleted.
         """
-        Provided a dataframe of recommended_songs, create Song objects corresponding to each row
-        in the df. Avoid duplicate songs, and skip the query record itself. 
+        with self._catalog_lock:
+            num_retired = self._retire_songs(song_ids)
+        logger.info(f'retire_songs(): retired {num_retired} songs, catalog has {self.catalog.num_active} active songs')
+
+    def _retire_songs(self, song_ids: list[str]) -> int:
+        """
+        Retire songs from the catalog and the trie. The caller must hold self._catalog_lock.
+        Returns the number of songs retired.
+        """
+        retired_songs = self.catalog.retire_songs(song_ids)
+        if self.trie is not None:
+            for track_name, artists in zip(retired_songs['name'], retired_songs['artists']):
+                self.trie.remove_song(track_name, artists)
+        return len(retired_songs)
+
+    def _convert_df_to_songs(self, recommended_songs: pd.DataFrame) -> list[Song]:
+        """
+        Provided a dataframe of recommended_songs, create Song objects corresponding to each row in the df.
+        Duplicates and the query song were already skipped by the classifier, so every row is resolved exactly once.
         Each row of recommended_songs must have all the columns necessary to create a Song object.
         """
-        seen_songs = set([query_name.lower()])
         songs: list[Song] = []
         order_map = {}  # we'll need to maintain order after resolving the futures
 
         # helper function that the parallel workers will execute
         def get_song_object(index: int, song_name: str, artist_name: str):
-            if song_name.lower() in seen_songs:
-                return None, None
-            seen_songs.add(song_name.lower())
-            song = self.spotify_manager.search_song(song_name, artist_name)
+            song = self.spotify_manager.search_song(song_name, artist_name, priority=Priority.RECOMMENDATION)
             return index, song
 
         # parallelize the API calls
         with ThreadPoolExecutor() as executor:
             futures = [executor.submit(get_song_object, i, recommended_songs['name'].iloc[i], 
-                                       ast.literal_eval(recommended_songs['artists'].iloc[i])[0]) 
+                                       primary_artist(recommended_songs['artists'].iloc[i])) 
                        for i in range(len(recommended_songs))]
 
             for future in as_completed(futures):
@@ -88,97 +118,143 @@ class RecommendationsManager:
 
         return songs
     
-    def _get_knn_results(self, data_copy: pd.DataFrame, normalized_data: pd.DataFrame, query: np.ndarray, k: int) -> list[Song]:
+    def _get_knn_results(self, normalized_data: np.ndarray, query: np.ndarray, query_song: Song, k: int) -> list[Song]:
         """
-        Given a song's acoustic features, run it thorugh our CPU knn classifier, and get the k recommendations.
+        Given a song's acoustic features, run it thorugh self.classifier (CPU or GPU), and get the k recommendations.
         """
-        clf = MyKNeighborsClassifier(k, self.dist_metric, jit_compilation=False)
-        clf.fit(normalized_data)
-        distances, indices = clf.predict(query)
-        recommended_songs = data_copy.iloc[indices]
-        query_name: str = data_copy.iloc[-1]['name']
+        # fitting with the duplicate groups makes the classifier return k distinct songs, none of them the query itself.
+        # the catalog may have grown since normalized_data was read, and rows are only ever appended.
+        clf = self.classifier(k, self.dist_metric)
+        clf.fit(normalized_data, self.catalog.group_ids[:len(normalized_data)])
+        distances, indices = clf.predict(query, exclude_groups=self._query_groups(query_song))
+        return self._resolve_classifier_results(query_song, distances, indices)
 
-        self._print_classifier_results(data_copy, recommended_songs, distances)
-        return self._convert_df_to_songs(recommended_songs, query_name)
-    
-    def _get_gpu_knn_results(self, data_copy: pd.DataFrame, normalized_data: pd.DataFrame, query: np.ndarray, k: int) -> list[Song]:
+    def _query_row(self, query_song: Song) -> int | None:
         """
-        Given a song's acoustic features, run it thorugh our GPU knn classifier, and get the k recommendations.
+        Returns the catalog row of the query song, or None if it isn't in the catalog.
         """
-        clf = GpuKNeighbors(k, self.dist_metric)
-        clf.fit(normalized_data)
-        distances, indices = clf.predict(query)
-        recommended_songs = data_copy.iloc[indices]
-        query_name: str = data_copy.iloc[-1]['name']
+        # track uris look like spotify:track:{id}, and the id is what data.csv stores.
+        return self.catalog.row_for_id(query_song.track_uri.rsplit(':', 1)[-1])
 
-        self._print_classifier_results(data_copy, recommended_songs, distances)
-        return self._convert_df_to_songs(recommended_songs, query_name)
+    def _query_groups(self, query_song: Song) -> set[int]:
+        """
+        Returns the duplicate groups that recommendations for this query must skip: the query song's own group, if it's in the catalog.
+        The song is matched by its Spotify id and by name, since Spotify's names can differ from data.csv (like a "- Remastered" suffix).
+        """
+        groups = set()
+        if (row := self._query_row(query_song)) is not None:
+            groups.add(int(self.catalog.group_ids[row]))
+        if (group := self.catalog.group_for(query_song.song_name, query_song.artist_name)) is not None:
+            groups.add(group)
+        return groups
+
+    def _get_precomputed_results(self, query_song: Song, k: int) -> list[Song] | None:
+        """
+        If the query song is in the catalog and there's an up to date neighbor graph for self.dist_metric,
+        get its k recommendations from the graph. Returns None if the graph can't be used for this query.
+        """
+        graph = self.neighbor_graphs.get(self.dist_metric)
+        if graph is None:
+            return None
+        row = self._query_row(query_song)
+        if row is None or row >= graph.num_songs or not graph.is_current(self.catalog):
+            return None
+
+        distances, indices = graph.neighbors(row)
+        # songs added since the graph was built aren't in it, so scan just those and merge them in.
+        added_distances, added_indices = graph.added_song_distances(self.catalog, row)
+        distances = np.concatenate([distances, added_distances])
+        indices = np.concatenate([indices, added_indices])
+        active = self.catalog.active_mask(indices)
+        distances, indices = distances[active], indices[active]
+        # the graph already has one neighbor per duplicate group, but songs added since may have joined a group.
+        selected = select_k_nearest(distances, k, self.catalog.group_ids[indices], self._query_groups(query_song))
+        if len(selected) < k: # too many neighbors were retired since the graph was built
+            return None
+        distances, indices = distances[selected], indices[selected]
+        return self._resolve_classifier_results(query_song, distances, indices)
+
+    def _resolve_classifier_results(self, query_song: Song, distances: np.ndarray, indices: np.ndarray) -> list[Song]:
+        """
+        Look up the catalog rows the classifier picked and turn them into Song objects.
+        Retired songs have infinite distance, so they're dropped here.
+        """
+        found = np.isfinite(distances)
+        distances, indices = distances[found], indices[found]
+        recommended_songs = self.catalog.rows(indices)
+
+        logger.debug('%s', LazyFormat(self._format_classifier_results, query_song, recommended_songs, distances))
+        return self._convert_df_to_songs(recommended_songs)
     
-    def _print_classifier_results(self, data_copy: pd.DataFrame, recommended_songs: pd.DataFrame, distances: list[float]) -> None:
+    def _format_classifier_results(self, query_song: Song, recommended_songs: pd.DataFrame, distances: list[float]) -> str:
         """
-        Print the classifier results for debugging purposes.
+        Format the classifier results as a table for debugging purposes.
+        Only called when the debug log record is written, so it never runs on a request thread.
         """
-        query_name: str = data_copy.iloc[-1]['name']
-        query_artist: str = ast.literal_eval(data_copy.iloc[-1]['artists'])[0]
-        print(f'\n{self.classifier.__name__}(dist_metric={self.dist_metric}) Recommended Songs for {query_name} by {query_artist}:')
+        query_name: str = query_song.song_name
+        query_artist: str = query_song.artist_name
+        lines = [f'{self.classifier.__name__}(dist_metric={self.dist_metric}) Recommended Songs for {query_name} by {query_artist}:']
 
         # build a list of '{song} by {artist}' strings
-        song_artist_list: list[str] = []
-        for index in range(len(recommended_songs)):
-            song_name = recommended_songs['name'].iloc[index]
-            artist = ast.literal_eval(recommended_songs['artists'].iloc[index])[0]
-            song_artist_list.append(f'{song_name} by {artist}')
+        song_artist_list: list[str] = [
+            f'{song_name} by {primary_artist(artists)}'
+            for song_name, artists in zip(recommended_songs['name'], recommended_songs['artists'])
+        ]
 
         # get the maximum length for song-artist string
-        max_length = max(len(song_artist) for song_artist in song_artist_list)
+        max_length = max((len(song_artist) for song_artist in song_artist_list), default=0)
 
-        # print results with padding
+        # add the results with padding
         for index, song_artist in enumerate(song_artist_list):
             formatted_song = song_artist.ljust(max_length)
-            print(f'{index + 1}. {formatted_song} distance: {distances[index]:.4f}')
+            lines.append(f'{index + 1}. {formatted_song} distance: {distances[index]:.4f}')
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _songs_to_json(songs: list[Song]) -> str:
+        return json.dumps([s.to_dict() for s in songs], indent=4)
 
-    
     def get_recommendations(self, query: Song, num_recommendations: int = 5) -> list[Song]:
         """
-        Given a query, run it through self.classifier and get a list of Song recommendations.
-        """
-        # add this query to a copy of the dataset, normalize the data with the query in it, then call the classifier.
-        # the copying needs to be done otherwise normalization of the query will be incorrect.
-        data_copy = self.data.copy()
-        data_copy.loc[len(data_copy.index)] = query.get_features_to_create_df_entry()
-        normalized_data = self._normalize_data(data_copy[self.features])
-        normalized_query_record: np.ndarray = normalized_data[-1]
-
-        songs: list[Song] = None
-        if self.classifier == MyKNeighborsClassifier:
-            songs = self._get_knn_results(
-                data_copy=data_copy,
-                normalized_data=normalized_data,
-                query=normalized_query_record,
-                k=num_recommendations
-            )
-        elif self.classifier == GpuKNeighbors:
-            songs = self._get_gpu_knn_results(
-                data_copy=data_copy,
-                normalized_data=normalized_data,
-                query=normalized_query_record,
-                k=num_recommendations,
-            )
-        else:
+        Given a query, run it through self.classifier and get a list of num_recommendations distinct Song recommendations
+        (fewer only if a song can't be found on Spotify).
+        Songs that are in the catalog are looked up in the precomputed neighbor graph instead, if we have one.
+        """
+        if (songs := self._get_precomputed_results(query, num_recommendations)) is not None:
+            logger.info('get_recommendations(dist_metric=%s, query=%s), served %d songs from the neighbor graph', 
+                        self.dist_metric, query.song_name, len(songs))
+            logger.debug('get_recommendations(query=%s), returning %s', query.song_name, LazyFormat(self._songs_to_json, songs))
+            return songs
+
+        # normalize the query against the catalog. if the query is outside the catalog's bounds,
+        # the catalog gets rescaled for this request only, otherwise normalization of the query will be incorrect.
+        raw_query = np.array(query.get_features(self.features), dtype=np.float64)
+        normalized_data, normalized_query_record = self.catalog.normalize_query(raw_query)
+
+        # the GPU classifier isn't imported here, since importing numba.cuda is slow. Any KnnSongClassifier works.
+        if not (isinstance(self.classifier, type) and issubclass(self.classifier, KnnSongClassifier)):
             raise ValueError(f'Invalid classifier {self.classifier}!')
-        
-        logger.info(
-            f'get_recommendations(classifier={self.classifier.__name__}, query={query.song_name}), returning {json.dumps([s.to_dict() for s in songs], indent=4)}'
+
+        songs = self._get_knn_results(
+            normalized_data=normalized_data,
+            query=normalized_query_record,
+            query_song=query,
+            k=num_recommendations
         )
+        
+        logger.info('get_recommendations(classifier=%s, query=%s), returning %d songs', 
+                    self.classifier.__name__, query.song_name, len(songs))
+        logger.debug('get_recommendations(query=%s), returning %s', query.song_name, LazyFormat(self._songs_to_json, songs))
 
         return songs
 
 
 # test code, see if it works
 if __name__ == '__main__':
+    setup_logging()
     data = pd.read_csv('./data/data.csv')
     spotify_manager = SpotifyManager()
-    recommendations_manager = RecommendationsManager(data, DATA_FEATURES, spotify_manager)
+    recommendations_manager = RecommendationsManager(data, DATA_FEATURES, spotify_manager, MyKNeighborsClassifier)
     
     # 2 different songs to try out here
     # song = spotify_manager.search_song(song_name='Pedal Point Blues', artist_name='Charles Mingus')
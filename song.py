@@ -3,9 +3,7 @@ from __future__ import annotations
 import json
 import logging
 from dataclasses import dataclass, asdict
-from logging_config import setup_logging
 
-setup_logging()
 logger = logging.getLogger()
 
 @dataclass
@@ -0,0 +1,402 @@
+# song_catalog.py holds the local song dataset used by the RecommendationsManager.
+# it keeps a normalized copy of the feature matrix in memory so songs can be added or retired
+# while the app is running, without re-reading data.csv or re-normalizing the whole dataset per request.
+# updates are published as an immutable snapshot, so request threads can read the catalog while it's being updated.
+from __future__ import annotations
+import ast
+import logging
+import threading
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+MIN_CAPACITY = 1024
+GROWTH_FACTOR = 2
+
+def duplicate_key(song_name: str, artist_name: str) -> tuple[str, str]:
+    """
+    Returns the key used to detect duplicate songs: the lowercase song name and primary artist, with whitespace collapsed.
+    """
+    return ' '.join(str(song_name).lower().split()), ' '.join(str(artist_name).lower().split())
+
+def primary_artist(artists: str) -> str:
+    """
+    Returns the first artist from the string representation of a list[str], like the 'artists' column of data.csv.
+    """
+    try:
+        artist_list = ast.literal_eval(artists)
+    except (ValueError, SyntaxError):
+        return ''
+    return artist_list[0] if artist_list else ''
+
+@dataclass(frozen=True)
+class _CatalogState:
+    """
+    What readers of the catalog see. Each update builds a new state and swaps it in with a single assignment,
+    so a reader that grabs self._state once gets a consistent catalog, even while another thread is updating it.
+    The arrays are views of the first `size` rows of the writer's buffers. Rows that are already published are never
+    rewritten, except when a song is retired (its active flag is cleared and its normalized features set to infinity).
+    """
+    size: int
+    raw: np.ndarray
+    normalized: np.ndarray
+    active: np.ndarray
+    group_ids: np.ndarray
+    feature_min: np.ndarray
+    feature_max: np.ndarray
+    chunk_starts: list[int]
+    chunks: list[pd.DataFrame]
+
+class SongCatalog:
+    """
+    A growable table of songs and their min-max normalized features.
+
+    Rows are never moved once added, so a row index stays valid for the lifetime of the catalog.
+    Retired rows keep their slot, but their normalized features are set to infinity so
+    any distance computed against them sorts after every active song.
+
+    Rows that share a song name and primary artist (re-releases, remasters, etc) are put in the same duplicate group,
+    so the classifiers can return at most one song per group.
+
+    Updates (add_songs, retire_songs) are serialized by a lock. Reads don't take it: they see the last published state.
+    """
+    def __init__(self, data: pd.DataFrame, features: list[str]) -> None:
+        """
+        Initialize the catalog with the songs in data (a dataframe shaped like data.csv),
+        using the given list of numerical features for normalization.
+        """
+        self.features = features
+        self._columns: list[str] = list(data.columns)
+        self._write_lock = threading.Lock()
+
+        # the writer's buffers, which have room to grow. readers only use the views in self._state.
+        self._raw = np.empty((0, len(features)), dtype=np.float64)
+        self._normalized = np.empty((0, len(features)), dtype=np.float64)
+        self._active = np.empty(0, dtype=bool)
+        self._group_ids = np.empty(0, dtype=np.int64)
+        self._group_keys: dict[tuple[str, str], int] = {}
+        self._id_to_row: dict[str, int] = {}
+
+        self._state = _CatalogState(
+            size=0,
+            raw=self._raw,
+            normalized=self._normalized,
+            active=self._active,
+            group_ids=self._group_ids,
+            feature_min=np.full(len(features), np.inf),
+            feature_max=np.full(len(features), -np.inf),
+            chunk_starts=[], # song metadata is stored in chunks so appending doesn't copy the whole dataframe.
+            chunks=[],
+        )
+
+        self.add_songs(data)
+
+    def __len__(self) -> int:
+        """
+        Number of rows in the catalog, including retired rows.
+        """
+        return self._state.size
+
+    @property
+    def num_active(self) -> int:
+        return int(np.count_nonzero(self._state.active))
+
+    @property
+    def normalized(self) -> np.ndarray:
+        """
+        The normalized feature matrix, one row per catalog row. Retired rows are all infinity.
+        """
+        return self._state.normalized
+
+    @property
+    def group_ids(self) -> np.ndarray:
+        """
+        The duplicate group of each catalog row.
+        """
+        return self._state.group_ids
+
+    def group_for(self, song_name: str, artist_name: str) -> int | None:
+        """
+        Return the duplicate group of songs with this name and primary artist, or None if there aren't any in the catalog.
+        """
+        return self._group_keys.get(duplicate_key(song_name, artist_name))
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """
+        A dataframe of all active songs. This copies the catalog, so avoid it on hot paths.
+        """
+        state = self._state
+        if not state.chunks:
+            return pd.DataFrame(columns=self._columns)
+        return pd.concat(state.chunks, ignore_index=True).iloc[np.flatnonzero(state.active)]
+
+    @property
+    def bounds(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        The (min, max) of each raw feature over the active songs, which the normalization is based on.
+        """
+        state = self._state
+        return state.feature_min.copy(), state.feature_max.copy()
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Returns the values of a metadata column for every catalog row (retired rows included), indexed by row.
+        This copies the column, so avoid it on hot paths.
+        """
+        state = self._state
+        if not state.chunks:
+            return np.empty(0, dtype=object)
+        return np.concatenate([chunk[name].to_numpy() for chunk in state.chunks])
+
+    def is_active(self, row: int) -> bool:
+        state = self._state
+        return 0 <= row < state.size and bool(state.active[row])
+
+    def active_mask(self, indices: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean array telling which of these row indices are active songs. Out of range indices are inactive.
+        """
+        state = self._state
+        in_range = (indices >= 0) & (indices < state.size)
+        mask = np.zeros(len(indices), dtype=bool)
+        mask[in_range] = state.active[indices[in_range]]
+        return mask
+
+    def row_for_id(self, song_id: str) -> int | None:
+        """
+        Return the row index of the active song with this Spotify track id, or None if it isn't in the catalog.
+        """
+        return self._id_to_row.get(song_id)
+
+    def rows(self, indices: np.ndarray) -> pd.DataFrame:
+        """
+        Return the metadata rows for the given row indices, in the same order.
+        The returned dataframe is indexed by the row indices.
+        """
+        if len(indices) == 0:
+            return pd.DataFrame(columns=self._columns)
+        state = self._state
+        chunk_ids = np.searchsorted(state.chunk_starts, indices, side='right') - 1
+        selected = [
+            state.chunks[chunk_id].iloc[[row - state.chunk_starts[chunk_id]]]
+            for chunk_id, row in zip(chunk_ids, indices)
+        ]
+        return pd.concat(selected).set_axis(list(indices))
+
+    def add_songs(self, new_songs: pd.DataFrame) -> np.ndarray:
+        """
+        Append new_songs (a dataframe shaped like data.csv) to the catalog.
+        Only the new rows are normalized, unless the new songs move the min/max bounds
+        of a feature, in which case just that feature's column is rescaled.
+
+        Raises ValueError, leaving the catalog unchanged, if a column is missing or a song has a missing (NaN) feature.
+
+        Returns:
+            np.ndarray: the row indices assigned to the new songs.
+        """
+        missing_columns = (set(self.features) | {'name', 'artists'}) - set(new_songs.columns)
+        if missing_columns:
+            raise ValueError(f'Cannot add songs, missing columns: {sorted(missing_columns)}')
+
+        with self._write_lock:
+            state = self._state
+            num_new = len(new_songs)
+            new_rows = np.arange(state.size, state.size + num_new)
+            if num_new == 0:
+                return new_rows
+
+            new_songs = new_songs.reindex(columns=self._columns).reset_index(drop=True)
+            raw = new_songs[self.features].to_numpy(dtype=np.float64)
+            # a single NaN would become that feature's min/max, and make every normalized value of the feature NaN.
+            invalid = ~np.isfinite(raw).all(axis=1)
+            if invalid.any():
+                labels = new_songs['id'] if 'id' in new_songs.columns else new_songs['name']
+                raise ValueError(f'Cannot add songs with missing or non-finite features: {labels[invalid].tolist()}')
+
+            # the new rows are written past the published size (or to new buffers), where readers can't see them yet.
+            reallocated = self._reserve(state.size + num_new)
+            self._raw[new_rows] = raw
+            self._active[new_rows] = True
+            self._group_ids[new_rows] = [
+                self._group_keys.setdefault(duplicate_key(song_name, primary_artist(artists)), len(self._group_keys))
+                for song_name, artists in zip(new_songs['name'], new_songs['artists'])
+            ]
+
+            # only rescale the features whose bounds were moved by the new songs.
+            feature_min = np.minimum(state.feature_min, raw.min(axis=0))
+            feature_max = np.maximum(state.feature_max, raw.max(axis=0))
+            moved = (feature_min != state.feature_min) | (feature_max != state.feature_max)
+            if moved.any():
+                if not reallocated: # readers may be computing distances against the published matrix
+                    self._normalized = self._normalized.copy()
+                self._rescale(np.flatnonzero(moved), state.size, feature_min, feature_max)
+            low, scale = self._scale(feature_min, feature_max)
+            self._normalized[new_rows] = (raw - low) / scale
+
+            chunk_starts, chunks = self._merge_trailing_chunks(state.chunk_starts + [state.size], state.chunks + [new_songs])
+            self._publish(state.size + num_new, feature_min, feature_max, chunk_starts, chunks)
+
+            if 'id' in new_songs.columns:
+                for row, song_id in zip(new_rows, new_songs['id']):
+                    self._id_to_row[song_id] = int(row)
+
+        logger.info(f'Added {num_new} songs to the catalog, rescaled {int(moved.sum())} features')
+        return new_rows
+
+    def retire_songs(self, song_ids: list[str]) -> pd.DataFrame:
+        """
+        Retire the songs with these Spotify track ids so they are no longer recommended.
+        Ids that aren't in the catalog are ignored.
+
+        Returns:
+            pd.DataFrame: metadata of the songs that were retired.
+        """
+        with self._write_lock:
+            state = self._state
+            retired_rows = np.array(
+                [row for song_id in song_ids if (row := self._id_to_row.pop(song_id, None)) is not None],
+                dtype=np.int64
+            )
+            if len(retired_rows) == 0:
+                return self.rows(retired_rows)
+
+            # retiring a song in place is safe: readers just see it retired a little earlier.
+            self._active[retired_rows] = False
+            self._normalized[retired_rows] = np.inf
+
+            # the bounds can only shrink if a retired song sat on them, so only rescan those features.
+            feature_min, feature_max = state.feature_min.copy(), state.feature_max.copy()
+            retired_raw = self._raw[retired_rows]
+            on_bound = ((retired_raw == feature_min) | (retired_raw == feature_max)).any(axis=0)
+            if on_bound.any():
+                columns = np.flatnonzero(on_bound)
+                active_raw = self._raw[:state.size][self._active[:state.size]][:, columns]
+                if len(active_raw):
+                    feature_min[columns] = active_raw.min(axis=0)
+                    feature_max[columns] = active_raw.max(axis=0)
+                moved = columns[(feature_min[columns] != state.feature_min[columns]) | (feature_max[columns] != state.feature_max[columns])]
+                if len(moved):
+                    self._normalized = self._normalized.copy()
+                    self._rescale(moved, state.size, feature_min, feature_max)
+
+            self._publish(state.size, feature_min, feature_max, state.chunk_starts, state.chunks)
+
+        logger.info(f'Retired {len(retired_rows)} songs from the catalog')
+        return self.rows(retired_rows)
+
+    def normalize_query(self, raw_query: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Normalize a query's raw features the same way the catalog is normalized.
+
+        If the query is inside the catalog's bounds, the cached normalized matrix is returned as is.
+        Otherwise the bounds are widened to include the query, and a rescaled copy of the matrix
+        is returned instead (the catalog itself is left untouched).
+
+        Returns:
+            tuple(normalized_matrix, normalized_query)
+        """
+        if not np.isfinite(raw_query).all():
+            raise ValueError(f'Cannot normalize a query with missing or non-finite features: {raw_query}')
+        state = self._state
+        low = np.minimum(state.feature_min, raw_query)
+        high = np.maximum(state.feature_max, raw_query)
+        if np.array_equal(low, state.feature_min) and np.array_equal(high, state.feature_max):
+            low, scale = self._scale(state.feature_min, state.feature_max)
+            return state.normalized, (raw_query - low) / scale
+
+        scale = self._range_to_scale(high - low)
+        normalized = (state.raw - low) / scale
+        normalized[~state.active] = np.inf
+        return normalized, (raw_query - low) / scale
+
+    def normalize(self, raw: np.ndarray) -> np.ndarray:
+        """
+        Normalize raw feature rows with the catalog's current bounds. Unlike normalize_query(), the bounds are never widened,
+        so values outside of them just fall outside [0, 1]. Used for batches of queries.
+        """
+        state = self._state
+        low, scale = self._scale(state.feature_min, state.feature_max)
+        return (raw - low) / scale
+
+    @classmethod
+    def _scale(cls, feature_min: np.ndarray, feature_max: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the (low, scale) pair used to normalize raw features with these bounds: (raw - low) / scale.
+        """
+        return feature_min, cls._range_to_scale(feature_max - feature_min)
+
+    @staticmethod
+    def _range_to_scale(feature_range: np.ndarray) -> np.ndarray:
+        # like sklearn's MinMaxScaler, constant features are left unscaled.
+        return np.where(feature_range == 0, 1.0, feature_range)
+
+    def _rescale(self, columns: np.ndarray, size: int, feature_min: np.ndarray, feature_max: np.ndarray) -> None:
+        """
+        Recompute the normalized values of the given feature columns for the first size rows, with the new bounds.
+        """
+        low, scale = self._scale(feature_min, feature_max)
+        raw = self._raw[:size, columns]
+        normalized = (raw - low[columns]) / scale[columns]
+        normalized[~self._active[:size]] = np.inf
+        self._normalized[:size, columns] = normalized
+
+    def _publish(
+            self,
+            size: int,
+            feature_min: np.ndarray,
+            feature_max: np.ndarray,
+            chunk_starts: list[int],
+            chunks: list[pd.DataFrame]
+        ) -> None:
+        """
+        Make the first size rows of the buffers visible to readers. The caller must hold self._write_lock.
+        """
+        self._state = _CatalogState(
+            size=size,
+            raw=self._raw[:size],
+            normalized=self._normalized[:size],
+            active=self._active[:size],
+            group_ids=self._group_ids[:size],
+            feature_min=feature_min,
+            feature_max=feature_max,
+            chunk_starts=chunk_starts,
+            chunks=chunks,
+        )
+
+    def _reserve(self, capacity: int) -> bool:
+        """
+        Make sure the feature buffers can hold at least capacity rows, growing them geometrically.
+        Returns True if the buffers were reallocated (the published state still points at the old ones).
+        """
+        current_capacity = len(self._active)
+        if capacity <= current_capacity:
+            return False
+        new_capacity = max(capacity, current_capacity * GROWTH_FACTOR, MIN_CAPACITY)
+        num_features = len(self.features)
+        size = self._state.size
+
+        raw = np.empty((new_capacity, num_features), dtype=np.float64)
+        normalized = np.empty((new_capacity, num_features), dtype=np.float64)
+        active = np.zeros(new_capacity, dtype=bool)
+        group_ids = np.zeros(new_capacity, dtype=np.int64)
+        raw[:size] = self._raw[:size]
+        normalized[:size] = self._normalized[:size]
+        active[:size] = self._active[:size]
+        group_ids[:size] = self._group_ids[:size]
+        self._raw, self._normalized, self._active, self._group_ids = raw, normalized, active, group_ids
+        return True
+
+    @staticmethod
+    def _merge_trailing_chunks(chunk_starts: list[int], chunks: list[pd.DataFrame]) -> tuple[list[int], list[pd.DataFrame]]:
+        """
+        Merge the newest metadata chunks while the older one isn't bigger than the newer one.
+        This keeps the number of chunks logarithmic in the catalog size, and each row is only copied
+        a logarithmic number of times overall. The lists are modified in place (pass copies) and returned.
+        """
+        while len(chunks) > 1 and len(chunks[-2]) <= len(chunks[-1]):
+            chunks[-2:] = [pd.concat(chunks[-2:], ignore_index=True)]
+            chunk_starts.pop()
+        return chunk_starts, chunks
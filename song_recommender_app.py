@@ -1,58 +1,196 @@
-import pandas as pd
-from numba import cuda
+from __future__ import annotations
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING
 from flask import Flask, render_template, jsonify, request
+from flask.logging import default_handler
 from logging_config import setup_logging
-try:
-    from models.gpu_kneighbors import GpuKNeighbors
-except Exception as e:
-    pass
-from models.my_k_neighbors_classifier import MyKNeighborsClassifier
 from models.distance_metric import DistanceMetric
 from trie import Trie
-from spotify_manager import SpotifyManager
 from song import Song
-from recommendations_manager import RecommendationsManager, DATA_FEATURES
 
-data: pd.DataFrame
-trie: Trie
-spotify_manager: SpotifyManager
-recommendations_manager: RecommendationsManager
+# the heavy dependencies (pandas, numba, spotipy) are only imported inside init(),
+# so the app can start accepting requests before they're loaded.
+if TYPE_CHECKING:
+    import pandas as pd
+    from spotify_manager import SpotifyManager
+    from recommendations_manager import RecommendationsManager
+
+# set MUSIC_RECOMMENDER_FAST_START=1 to initialize in the background, after the server is already up.
+FAST_START = os.environ.get('MUSIC_RECOMMENDER_FAST_START', '0') == '1'
+
+# how long browsers and proxies may reuse an /api/autocomplete response before revalidating it with its ETag.
+AUTOCOMPLETE_MAX_AGE = 300
+
+# built by neighbor_graph.py. If it doesn't exist, every search falls back to the classifiers.
+NEIGHBOR_GRAPH_DIR = './data/neighbor_graph'
+
+data: pd.DataFrame | None = None
+trie: Trie | None = None
+spotify_manager: SpotifyManager | None = None
+recommendations_manager: RecommendationsManager | None = None
+# logging is set up before app.logger is first used, otherwise flask attaches its own stderr handler to it,
+# and the app's records would be formatted and written on the request threads instead of going through the queue.
+setup_logging()
 app = Flask(__name__)
+app.logger.removeHandler(default_handler)
 print('Music Recommender Flask App Started')
 app.logger.info('Music Recommender Flask App Started')
 
-def init() -> None:
-    global data, trie, spotify_manager, recommendations_manager
-    setup_logging()
-    print('**Initializing**')
-    print('Reading data.csv...', end='')
-    data = pd.read_csv('./data/data.csv')
-    print('Done.\nInitializing trie...', end='')
-    trie = Trie.from_list_of_names(data[['name', 'artists']])
-    print('Done.\nInitializing spotify_manager...', end='')
-    spotify_manager = SpotifyManager()
+_cuda_probe: Future | None = None
+_init_status: dict[str, str] = {step: 'pending' for step in ('data', 'trie', 'spotify_manager', 'distance_metrics', 'recommendations_manager')}
+
+def _probe_cuda() -> bool:
+    """
+    Check whether a CUDA GPU can be used. Importing numba.cuda and creating the driver context is slow,
+    so this runs once in the background.
+    """
+    try:
+        from numba import cuda
+        return cuda.is_available()
+    except Exception:
+        return False
 
+def _start_cuda_probe() -> None:
+    global _cuda_probe
+    if _cuda_probe is None:
+        _cuda_probe = Future()
+        def run_probe() -> None:
+            _cuda_probe.set_result(_probe_cuda())
+        threading.Thread(target=run_probe, name='cuda-probe', daemon=True).start()
+
+def cuda_available() -> bool:
+    """
+    Whether the GPU classifier can be used. Returns False until the background CUDA probe is done.
+    """
+    return _cuda_probe is not None and _cuda_probe.done() and _cuda_probe.result()
+
+def _run_init_step(step: str, func, *args, **kwargs):
+    """
+    Run one initialization step and record its outcome for the /readyz endpoint.
+    """
     try:
-        classifier = GpuKNeighbors if cuda.is_available() else MyKNeighborsClassifier
-    except Exception as e:
-        classifier = MyKNeighborsClassifier
-
-    print(f'Done.\nInitializing recommendations_manager...', end='')
-    recommendations_manager = RecommendationsManager(
-        data=data, 
-        features=DATA_FEATURES, 
-        spotify_manager=spotify_manager,
-        classifier=classifier
-    )
-    print('Done. Go to localhost:5000 to start searching!')
+        result = func(*args, **kwargs)
+    except Exception:
+        _init_status[step] = 'failed'
+        app.logger.exception(f'init(): step {step} failed')
+        raise
+    _init_status[step] = 'ready'
+    return result
+
+def _skip_init_steps(*steps: str) -> None:
+    """
+    Mark steps that can't run because a step they depend on failed, so /readyz doesn't report them as pending forever.
+    """
+    for step in steps:
+        if _init_status[step] == 'pending':
+            _init_status[step] = 'skipped'
+
+def _warm_up_distance_metrics() -> None:
+    """
+    Compile every distance metric now, so the first search doesn't wait on the JIT.
+    """
+    from models.features import DATA_FEATURES
+    from models.metric_registry import warm_up
+    warm_up(num_features=len(DATA_FEATURES), gpu=_cuda_probe.result())
+
+def _build_trie(names: pd.DataFrame) -> Trie:
+    """
+    Build the autocomplete trie and publish it right away, so autocomplete doesn't wait for the other init steps.
+    """
+    global trie
+    trie = Trie.from_list_of_names(names)
+    return trie
+
+def _init_components() -> None:
+    """
+    Load everything the routes need. Independent steps run concurrently,
+    and each global is published as soon as it's ready (so autocomplete works before spotify is authenticated, etc).
+    """
+    global data, spotify_manager, recommendations_manager
+    import pandas as pd
+    from models.my_k_neighbors_classifier import MyKNeighborsClassifier
+    from models.features import DATA_FEATURES
+    from recommendations_manager import RecommendationsManager
+    from spotify_manager import SpotifyManager
+
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix='init') as executor:
+        spotify_future = executor.submit(_run_init_step, 'spotify_manager', SpotifyManager)
+        warm_up_future = executor.submit(_run_init_step, 'distance_metrics', _warm_up_distance_metrics)
+        try:
+            data = _run_init_step('data', pd.read_csv, './data/data.csv')
+        except Exception:
+            _skip_init_steps('trie', 'recommendations_manager')
+            raise
+        trie_future = executor.submit(_run_init_step, 'trie', _build_trie, data[['name', 'artists']])
+
+        try:
+            spotify_manager = spotify_future.result()
+        except Exception:
+            _skip_init_steps('recommendations_manager')
+            raise
+        manager = _run_init_step(
+            'recommendations_manager',
+            RecommendationsManager,
+            data=data,
+            features=DATA_FEATURES,
+            spotify_manager=spotify_manager,
+            classifier=MyKNeighborsClassifier,
+            neighbor_graph_dir=NEIGHBOR_GRAPH_DIR
+        )
+        # keep the trie in sync with songs added or retired through the manager. if the trie failed,
+        # searches still work without autocomplete, and /readyz reports the failed step.
+        if trie_future.exception() is None:
+            manager.trie = trie_future.result()
+        recommendations_manager = manager
+        warm_up_future.result()
+
+    print('Initialization done. Go to localhost:5000 to start searching!')
+
+def init(background: bool = FAST_START) -> None:
+    """
+    Initialize the app. With background=True this returns right away,
+    and /readyz reports when the app can serve searches.
+    """
+    print('**Initializing**')
+    _start_cuda_probe()
+    if background:
+        threading.Thread(target=_init_components, name='init', daemon=True).start()
+    else:
+        _init_components()
+
+def _get_classifier(gpu_enabled: bool) -> type:
+    """
+    Returns the classifier class to use. The GPU classifier is only imported once it's actually requested.
+    """
+    if gpu_enabled and cuda_available():
+        from models.gpu_kneighbors import GpuKNeighbors
+        return GpuKNeighbors
+    from models.my_k_neighbors_classifier import MyKNeighborsClassifier
+    return MyKNeighborsClassifier
+
+@app.route('/healthz')
+def healthz():
+    """
+    Liveness: the process is up and serving requests, even if it's still initializing.
+    """
+    return jsonify(status='alive')
+
+@app.route('/readyz')
+def readyz():
+    """
+    Readiness: every initialization step is done, so the app can serve searches.
+    Returns 503 with the status of each step until then.
+    """
+    ready = all(status == 'ready' for status in _init_status.values())
+    return jsonify(ready=ready, steps=_init_status), 200 if ready else 503
 
 @app.route('/')
 def home():
-    try:
-        cuda_available = cuda.is_available()
-    except Exception as e:
-        cuda_available = False
-    return render_template('index.html', cuda_available=cuda_available)
+    return render_template('index.html', cuda_available=cuda_available())
 
 @app.route('/autocomplete')
 def autocomplete() -> str:
@@ -61,14 +199,37 @@ def autocomplete() -> str:
     If prefix is an empty string, return no suggestions.
     Returns an html response to the client.
     """
+    if trie is None:
+        return render_template('autocomplete.html', suggestions=[]), 503
+
     prefix = request.args.get('prefix', '')
     if prefix:
         autocomplete_results = trie.get_autocomplete_suggestions(prefix=prefix, limit=5)
     else:
         autocomplete_results = []
-    app.logger.info(f'autocomplete({prefix=}): autocomplete_results: {autocomplete_results}')
+    app.logger.debug('autocomplete(prefix=%r): autocomplete_results: %s', prefix, autocomplete_results)
     return render_template('autocomplete.html', suggestions=autocomplete_results)
 
+@app.route('/api/autocomplete')
+def autocomplete_json():
+    """
+    JSON version of /autocomplete: {"prefix": ..., "suggestions": [...]}.
+    Responses carry an ETag and a Cache-Control max-age, so browsers and a reverse proxy can reuse them,
+    and a request with a matching If-None-Match gets an empty 304.
+    """
+    if trie is None:
+        return jsonify(prefix='', suggestions=[]), 503
+
+    prefix = request.args.get('prefix', '')
+    suggestions = trie.get_autocomplete_suggestions(prefix=prefix, limit=5) if prefix else []
+    body = json.dumps({'prefix': prefix, 'suggestions': suggestions}, separators=(',', ':'))
+
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body.encode()).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = AUTOCOMPLETE_MAX_AGE
+    return response.make_conditional(request)
+
 @app.route('/recommendations')
 def recommendations():
     """
@@ -77,37 +238,35 @@ def recommendations():
     An example GET request could look like:
         "/recommendations?query=your_song_name&gpuEnabled=true&distanceMetric=euclidean&fromAutocomplete=false
     """
+    if recommendations_manager is None:
+        return render_template('recommendations.html', main_song=None, recommendations=[]), 503
+
     query = request.args.get('query', '')
     artist_name = None
     from_autocomplete = request.args.get('fromAutocomplete', 'false') == 'true'
     gpu_enabled = request.args.get('gpuEnabled', 'false') == 'true'
     dist_metric = request.args.get('distanceMetric', 'euclidean')
 
-    if dist_metric == 'euclidean':
-        recommendations_manager.dist_metric = DistanceMetric.EUCLIDEAN
-    elif dist_metric == 'manhattan':
-        recommendations_manager.dist_metric = DistanceMetric.MANHATTAN
-    else:
-        app.logger.warning(f'Unexpected distance metric in recommendations(): {dist_metric}')
+    try:
+        recommendations_manager.dist_metric = DistanceMetric[dist_metric.upper()]
+    except KeyError:
+        app.logger.warning('Unexpected distance metric in recommendations(): %s', dist_metric)
 
     # make sure we run on the correct model
-    if gpu_enabled:
-        recommendations_manager.classifier = GpuKNeighbors
-    else:
-        recommendations_manager.classifier = MyKNeighborsClassifier
+    recommendations_manager.classifier = _get_classifier(gpu_enabled)
 
     # if the request was made with autocomplete, we know the input will be: '{song_name} by {artist}'
     if from_autocomplete:
         query, artist_name = query.rsplit('by', 1)
 
-    print(f'recommendations({query=}, {artist_name=}, {gpu_enabled=}, {dist_metric=}) called!')
+    app.logger.debug('recommendations(query=%r, artist_name=%r, gpu_enabled=%s, dist_metric=%r) called!', query, artist_name, gpu_enabled, dist_metric)
 
     if query and (song := spotify_manager.search_song(song_name=query, artist_name=artist_name)):
-        recommendations: list[Song] = recommendations_manager.get_recommendations(song, num_recommendations=10)[:5]
-        app.logger.info(f'recommendations({query=}, {artist_name=}, {gpu_enabled=}), found {len(recommendations)} recommendations!')
+        recommendations: list[Song] = recommendations_manager.get_recommendations(song, num_recommendations=5)
+        app.logger.info('recommendations(query=%r, artist_name=%r, gpu_enabled=%s), found %d recommendations!', query, artist_name, gpu_enabled, len(recommendations))
         return render_template('recommendations.html', main_song=song, recommendations=recommendations)
     
-    app.logger.info(f'recommendations({query=}, {artist_name=}, {gpu_enabled=}), found no recommendations.')
+    app.logger.info('recommendations(query=%r, artist_name=%r, gpu_enabled=%s), found no recommendations.', query, artist_name, gpu_enabled)
     return render_template('recommendations.html', main_song=None, recommendations=[])
 
 if __name__ == '__main__':
@@ -1,17 +1,52 @@
+from __future__ import annotations
 import os
-import spotipy
 import logging
-from spotipy.oauth2 import SpotifyClientCredentials
+from typing import TYPE_CHECKING
 from song import Song
+from spotify_scheduler import Priority, RateLimitScheduler, SingleFlight
 from logging_config import setup_logging
 
-setup_logging()
 logger = logging.getLogger(__name__)
 
+if TYPE_CHECKING:
+    import requests
+    import spotipy
+
+def build_requests_session() -> requests.Session:
+    """
+    Returns the requests session used by the spotipy client. It retries connection errors and 5xx responses like spotipy's
+    default session, but never a 429: those are left to our RateLimitScheduler, so a worker thread doesn't sleep
+    inside urllib3, and the SpotifyException it gets still has the Retry-After header.
+    status_forcelist alone isn't enough, urllib3 retries a 429 that has a Retry-After header
+    unless respect_retry_after_header is off.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    retry = Retry(
+        total=3,
+        status=3,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        respect_retry_after_header=False,
+    )
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class SpotifyManager:
     """Class to manage song search queries."""
-    def __init__(self) -> None:
+    def __init__(self, scheduler: RateLimitScheduler | None = None) -> None:
+        """
+        Every API call goes through the scheduler (a default one is created if none is passed),
+        and concurrent searches for the same song at the same priority share one lookup.
+        """
         self._sp = self._get_spotify_api_client()
+        self._scheduler = scheduler if scheduler is not None else RateLimitScheduler()
+        self._single_flight = SingleFlight()
 
     @staticmethod
     def _load_spotify_credentials(filename: str) -> None:
@@ -28,44 +63,58 @@ class SpotifyManager:
         """
         Return an initialized and authenticated Spotify object, ready for searches and API calls.
         """
+        # spotipy is imported here since it's slow to import and only needed once the app is initializing.
+        import spotipy
+        from spotipy.oauth2 import SpotifyClientCredentials
         self._load_spotify_credentials('spotify_credentials.txt')
         client_credentials_mananger = SpotifyClientCredentials()
-        spotify = spotipy.Spotify(auth_manager=client_credentials_mananger)
+        # 429s are left to our RateLimitScheduler, see build_requests_session()
+        spotify = spotipy.Spotify(auth_manager=client_credentials_mananger, requests_session=build_requests_session())
         return spotify
     
-    def _search_track_features(self, track_uri: str) -> list | None:
+    def _search_track_features(self, track_uri: str, priority: Priority) -> list | None:
         """
         Return a list of audio features of this track, such as valence, acousticness, etc...
         Returns None on failure.
         """
         # audio_features should be a list of dicts. Since we're only searching for 1 track, we only need the first list entry.
-        audio_features: list | None = self._sp.audio_features(tracks=[track_uri])
+        audio_features: list | None = self._scheduler.run(lambda: self._sp.audio_features(tracks=[track_uri]), priority)
         if not audio_features:
             return None
         return audio_features[0]
     
-    def search_song(self, song_name: str, artist_name: str | None = None) -> Song | None:
+    def search_song(self, song_name: str, artist_name: str | None = None, priority: Priority = Priority.QUERY) -> Song | None:
         """
         Try to search for song_name using the spotify API. 
         Returns a populated Song object or None on failure.
+        Use Priority.RECOMMENDATION for lookups that can wait behind the user's own search.
         """
         query = f'{song_name} {artist_name}' if artist_name is not None else song_name
-        results = self._sp.search(q=query, limit=1, type='track')
+        # the priority is part of the key, so the user's own search never waits behind a recommendation lookup.
+        return self._single_flight.do((query.lower(), priority), lambda: self._search_song(song_name, query, priority))
+
+    def _search_song(self, song_name: str, query: str, priority: Priority) -> Song | None:
+        """
+        Run the search and audio features API calls for search_song().
+        """
+        results = self._scheduler.run(lambda: self._sp.search(q=query, limit=1, type='track'), priority)
         if not results or not results['tracks']['items']:
-            logger.warning(f'search_song({song_name=}): did not get any results!')
+            logger.warning('search_song(song_name=%r): did not get any results!', song_name)
             return None
         
-        features = self._search_track_features(results['tracks']['items'][0]['uri'])
+        features = self._search_track_features(results['tracks']['items'][0]['uri'], priority)
         if not features:
-            logger.warning(f'search_song({song_name=}): did not get song features!')
+            logger.warning('search_song(song_name=%r): did not get song features!', song_name)
             return None
         
         song = Song.from_dict_and_features(results, features)
-        logger.info(f'search_song({query=}), created song object: {song}')
+        # str(song) dumps the whole song as json, so it's only done if this debug record is actually written.
+        logger.debug('search_song(query=%r), created song object: %s', query, song)
         return song
 
 # Try it out, test code.
 if __name__ == '__main__':
+    setup_logging()
     spotify_manager = SpotifyManager()
     # here's a query that won't work: ASD,A;SDQADXXC
     name = 'Forever Young Blackpink'
@@ -0,0 +1,228 @@
+# spotify_scheduler.py controls how the app calls the Spotify API under load.
+# - SingleFlight makes concurrent identical lookups share one in-flight call.
+# - RateLimitScheduler is a client-side token bucket: calls wait for a token in priority order,
+#   and when Spotify answers 429 every caller backs off for the Retry-After it sent (instead of stalling in spotipy's retries).
+from __future__ import annotations
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from enum import IntEnum
+from typing import Any, Callable, Hashable, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+REQUESTS_PER_SECOND = 10.0
+BURST = 20
+MAX_RETRIES = 3
+DEFAULT_RETRY_AFTER = 1.0 # seconds, used when a 429 doesn't come with a Retry-After header
+
+class Priority(IntEnum):
+    """
+    Priority of a Spotify API call, lower goes first.
+    """
+    QUERY = 0           # the song the user searched for
+    RECOMMENDATION = 1  # metadata for the recommendations
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls: while a call for a key is in flight, other callers with the same key
+    wait for its result instead of making their own call.
+    """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._in_flight: dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, func: Callable[[], T]) -> T:
+        """
+        Call func, unless a call for key is already in flight, in which case return (or raise) that call's result.
+        """
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not is_leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+def retry_after(exception: BaseException) -> float | None:
+    """
+    If exception is a 429 (too many requests) response, return how many seconds to wait before retrying.
+    Otherwise return None. Works with spotipy's SpotifyException (http_status) and urllib's HTTPError (code).
+    """
+    status = getattr(exception, 'http_status', None) or getattr(exception, 'code', None)
+    if status != 429:
+        return None
+    headers = getattr(exception, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After', DEFAULT_RETRY_AFTER))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+class RateLimitScheduler:
+    """
+    A token bucket shared by every thread that calls the Spotify API.
+    Tokens refill at `rate` per second up to `burst`. Waiting callers are served in priority order (FIFO within a priority).
+    """
+    def __init__(self, rate: float = REQUESTS_PER_SECOND, burst: int = BURST, max_retries: int = MAX_RETRIES) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self._tokens = float(burst)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._waiting: list[tuple[int, int]] = [] # heap of (priority, ticket)
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+
+    def run(self, func: Callable[[], T], priority: Priority = Priority.QUERY) -> T:
+        """
+        Call func once a token is available. If it fails with a 429, pause the whole bucket for the Retry-After
+        and try again (at most max_retries times).
+        """
+        for attempt in range(self.max_retries + 1):
+            self._acquire(priority)
+            try:
+                return func()
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None or attempt == self.max_retries:
+                    raise
+                logger.warning('Rate limited by Spotify, pausing requests for %ss (attempt %d)', wait, attempt + 1)
+                self._pause(wait)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _acquire(self, priority: Priority) -> None:
+        """
+        Block until this caller is the highest priority waiter, the bucket isn't paused and a token is available.
+        """
+        with self._condition:
+            ticket = (int(priority), next(self._tickets))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self._waiting[0] == ticket and now >= self._paused_until and self._tokens >= 1:
+                    heapq.heappop(self._waiting)
+                    self._tokens -= 1
+                    self._condition.notify_all() # the next waiter is now at the front
+                    return
+
+                timeout: float | None = None
+                if self._waiting[0] == ticket:
+                    if now < self._paused_until:
+                        timeout = self._paused_until - now
+                    else:
+                        timeout = (1 - self._tokens) / self.rate
+                self._condition.wait(timeout)
+
+    def _pause(self, seconds: float) -> None:
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._condition.notify_all()
+
+# test it out against a local fake server that adds latency and answers 429 to the first requests.
+if __name__ == '__main__':
+    import json
+    import urllib.request
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from concurrent.futures import ThreadPoolExecutor
+
+    upstream_calls: list[str] = []
+    rate_limited_left = [2]
+
+    class FakeSpotifyHandler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            upstream_calls.append(self.path)
+            if rate_limited_left[0] > 0:
+                rate_limited_left[0] -= 1
+                self.send_response(429)
+                self.send_header('Retry-After', '1')
+                self.end_headers()
+                return
+            time.sleep(0.2) # latency
+            body = json.dumps({'path': self.path}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSpotifyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_address[1]}'
+
+    single_flight = SingleFlight()
+    scheduler = RateLimitScheduler(rate=5, burst=2)
+    completed: list[tuple[str, Priority]] = []
+
+    def lookup(track: str, priority: Priority) -> dict:
+        def fetch() -> dict:
+            with urllib.request.urlopen(f'{base_url}/{track}') as response:
+                return json.loads(response.read())
+        result = single_flight.do(track, lambda: scheduler.run(fetch, priority))
+        completed.append((track, priority))
+        return result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        # 10 concurrent lookups for each of 3 popular tracks, then the user's query song
+        futures = [executor.submit(lookup, f'popular-{i % 3}', Priority.RECOMMENDATION) for i in range(30)]
+        futures += [executor.submit(lookup, f'rec-{i}', Priority.RECOMMENDATION) for i in range(5)]
+        futures.append(executor.submit(lookup, 'query', Priority.QUERY))
+        results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+    num_429 = 2
+    print(f'{len(results)} lookups in {elapsed:.2f}s, {len(upstream_calls)} upstream calls ({num_429} answered 429)')
+    assert len(upstream_calls) == 3 + 5 + 1 + num_429, upstream_calls
+    finish_order = [track for track, _ in completed]
+    print(f'finish order: {finish_order}')
+    assert all(finish_order.index('query') < finish_order.index(f'rec-{i}') for i in range(5)), \
+        'the query song should go before the recommendations that were already waiting'
+
+    # the same 429 through a spotipy client with SpotifyManager's session: it must reach the scheduler as a SpotifyException
+    # with its Retry-After header, instead of being retried inside urllib3.
+    import spotipy
+    from spotify_manager import build_requests_session
+    logging.getLogger('spotipy').setLevel(logging.CRITICAL) # spotipy logs every http error it raises
+    sp = spotipy.Spotify(auth='fake-token', requests_session=build_requests_session())
+    sp.prefix = f'{base_url}/v1/'
+    upstream_calls.clear()
+    rate_limited_left[0] = 1
+    spotipy_scheduler = RateLimitScheduler(rate=5, burst=2)
+    attempts: list[float] = []
+
+    def get_track() -> dict:
+        attempts.append(time.perf_counter())
+        return sp.track('4iV5W9uYEdYUVa79Axb7Rh')
+
+    track = spotipy_scheduler.run(get_track)
+    server.shutdown()
+    print(f'spotipy: {len(attempts)} attempts, {len(upstream_calls)} upstream calls, retried after {attempts[-1] - attempts[0]:.2f}s')
+    assert track['path'].startswith('/v1/tracks/'), track
+    assert len(upstream_calls) == 2 and len(attempts) == 2, 'the 429 should be retried by the scheduler, not by urllib3'
+    assert attempts[1] - attempts[0] >= 1.0, 'the scheduler should wait for the Retry-After header before retrying'
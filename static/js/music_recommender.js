@@ -126,11 +126,14 @@ function fetchAutocompleteSuggestions() {
         clearSuggestions();
         return;
     }
-    // The server will return html we can insert directly into the DOM
-    fetch('/autocomplete?prefix=' + encodeURIComponent(inputVal))
-        .then(response => response.text())  // Expect a text (HTML) response
-        .then(html => {
-            document.getElementById('suggestionsContainer').innerHTML = html;
+    // The server returns a small cacheable json response, so repeated prefixes can be served by the browser cache
+    fetch('/api/autocomplete?prefix=' + encodeURIComponent(inputVal))
+        .then(response => response.json())
+        .then(data => {
+            // ignore responses for a prefix the user has already typed past
+            if (data.prefix === document.getElementById('searchInput').value) {
+                displaySuggestions(data.suggestions);
+            }
         })
         .catch(error => console.error('Error fetching autocomplete suggestions:', error));
 }
@@ -149,7 +152,7 @@ function displaySuggestions(suggestions) {
         div.className = 'suggestion-item';
         div.innerText = suggestion;
         div.onclick = function() {
-            selectSuggestion(suggestion);
+            selectSuggestion(div);
         };
         suggestionsContainer.appendChild(div);
     });
@@ -3,24 +3,37 @@
 from __future__ import annotations
 import logging
 import ast
-import pandas as pd
-import numpy as np
-from sklearn.utils import shuffle
+import threading
+from itertools import islice
+from typing import TYPE_CHECKING
 from logging_config import setup_logging
 
-setup_logging()
+if TYPE_CHECKING:
+    import pandas as pd
+
 logger = logging.getLogger(__name__)
 
+# results for prefixes up to this long are cached. they're the most common queries (every search starts with them)
+# and the most expensive, since the search has to walk the biggest subtrees, but there are only a few thousand of them.
+HOT_PREFIX_LENGTH = 2
+HOT_PREFIX_LIMIT = 10 # number of suggestions cached per hot prefix, requests for more bypass the cache
+
 class TrieNode:
     def __init__(self) -> None:
         self.children: dict[str, TrieNode] = {}
         self.is_end_of_word = False
-        self.original_words = []  # original words with capitalization etc
+        self.original_words: dict[str, int] = {}  # original words with capitalization etc, and how many times each was inserted
 
 class Trie:
     """A Trie data structure for efficient prefix-based searching."""
-    def __init__(self) -> None:
+    def __init__(self, hot_prefix_length: int = HOT_PREFIX_LENGTH) -> None:
         self.root = TrieNode()
+        self.hot_prefix_length = hot_prefix_length
+        self._hot_prefix_cache: dict[str, list[str]] = {}
+        # songs can be inserted or removed while the app is serving autocomplete requests, so updates, searches
+        # that walk the nodes, and filling the hot prefix cache hold this lock (so a search racing with an update never
+        # caches stale results). a search is capped at a few suggestions, so it's only held briefly.
+        self._lock = threading.Lock()
 
     @classmethod
     def from_list_of_names(cls, songs_df: pd.DataFrame, sample_frac: float | None = None) -> Trie:
@@ -43,29 +56,76 @@ class Trie:
         songs_df = songs_df.sample(frac=1).reset_index(drop=True)
 
         for _, row in songs_df.iterrows():
-            # try to insert {song} by {artist}. If no artist, then insert just the song name.
-            track_name = row['name']
-            artist_list = ast.literal_eval(row['artists'])
-            if artist_list:
-                trie.insert(f'{track_name} by {artist_list[0]}')
-            else:
-                trie.insert(track_name)
+            trie.insert_song(row['name'], row['artists'])
+        trie.warm_hot_prefixes()
 
         logging.info(f'Created Trie, inserted {len(songs_df)} song-artist combinations')
         return trie
 
+    @staticmethod
+    def _song_entry(track_name: str, artists: str) -> str:
+        """
+        Returns the autocomplete entry for a song: {song} by {artist}. If no artist, then just the song name.
+        artists is the string representation of a list[str], like the 'artists' column of data.csv.
+        """
+        artist_list = ast.literal_eval(artists)
+        if artist_list:
+            return f'{track_name} by {artist_list[0]}'
+        return track_name
+
+    def insert_song(self, track_name: str, artists: str) -> None:
+        """
+        Insert the autocomplete entry for this song into the Trie.
+        """
+        self.insert(self._song_entry(track_name, artists))
+
+    def remove_song(self, track_name: str, artists: str) -> None:
+        """
+        Remove the autocomplete entry for this song from the Trie.
+        """
+        self.remove(self._song_entry(track_name, artists))
+
     def insert(self, word: str) -> None:
         """
         Insert this word into the Trie.
         """
-        node = self.root
-        for char in word.lower(): # use lowercase chars as keys in the children
-            if char not in node.children:
-                node.children[char] = TrieNode()
-            node = node.children[char]
-        node.is_end_of_word = True
-        if word not in node.original_words: # here we store the words with proper capitalization
-            node.original_words.append(word)
+        with self._lock:
+            node = self.root
+            for char in word.lower(): # use lowercase chars as keys in the children
+                if char not in node.children:
+                    node.children[char] = TrieNode()
+                node = node.children[char]
+            node.is_end_of_word = True
+            # here we store the words with proper capitalization, counting duplicates so removal is safe.
+            node.original_words[word] = node.original_words.get(word, 0) + 1
+            self._invalidate_hot_prefixes(word)
+
+    def remove(self, word: str) -> None:
+        """
+        Remove one occurrence of this word from the Trie. Does nothing if the word isn't in the Trie.
+        Nodes that no longer lead to any word are pruned.
+        """
+        with self._lock:
+            path = [self.root]
+            for char in word.lower():
+                if char not in path[-1].children:
+                    return
+                path.append(path[-1].children[char])
+
+            node = path[-1]
+            if word not in node.original_words:
+                return
+            node.original_words[word] -= 1
+            if node.original_words[word] == 0:
+                del node.original_words[word]
+            node.is_end_of_word = bool(node.original_words)
+            self._invalidate_hot_prefixes(word)
+
+            # walk back up and prune the nodes that are now empty
+            for char, parent, child in zip(reversed(word.lower()), reversed(path[:-1]), reversed(path[1:])):
+                if child.is_end_of_word or child.children:
+                    break
+                del parent.children[char]
 
     def _search(self, node: TrieNode, limit: int, suggestions: list[str]) -> None:
         """
@@ -82,7 +142,7 @@ class Trie:
             return
         
         if node.is_end_of_word:
-            suggestions.extend(node.original_words[:limit - len(suggestions)])
+            suggestions.extend(islice(node.original_words, limit - len(suggestions)))
 
         for char, next_node in node.children.items():
             self._search(next_node, limit, suggestions)
@@ -98,8 +158,25 @@ class Trie:
         Returns:
             list[str]: A list of autocomplete suggestions.
         """
+        key = prefix.lower()
+        if len(key) > self.hot_prefix_length or limit > HOT_PREFIX_LIMIT:
+            with self._lock:
+                return self._get_suggestions(key, limit)
+
+        suggestions = self._hot_prefix_cache.get(key)
+        if suggestions is None:
+            with self._lock:
+                suggestions = self._get_suggestions(key, HOT_PREFIX_LIMIT)
+                self._hot_prefix_cache[key] = suggestions
+        return suggestions[:limit]
+
+    def _get_suggestions(self, key: str, limit: int) -> list[str]:
+        """
+        Walk the Trie down to the lowercase prefix key, then search below it for up to limit suggestions.
+        The caller must hold self._lock.
+        """
         node = self.root
-        for char in prefix.lower():
+        for char in key:
             if char not in node.children:
                 return []
             node = node.children[char]
@@ -107,9 +184,33 @@ class Trie:
         suggestions = []    
         self._search(node, limit, suggestions)
         return suggestions
+
+    def warm_hot_prefixes(self) -> None:
+        """
+        Fill the cache for every hot prefix (every prefix of up to hot_prefix_length characters) in the Trie.
+        """
+        with self._lock:
+            keys = ['']
+            nodes = [('', self.root)]
+            for _ in range(self.hot_prefix_length):
+                nodes = [(key + char, child) for key, node in nodes for char, child in node.children.items()]
+                keys.extend(key for key, _ in nodes)
+        for key in keys[1:]:
+            self.get_autocomplete_suggestions(key, HOT_PREFIX_LIMIT)
+
+    def _invalidate_hot_prefixes(self, word: str) -> None:
+        """
+        Drop the cached results of the hot prefixes of this word, since its insertion or removal may change them.
+        The caller must hold self._lock.
+        """
+        key = word.lower()
+        for length in range(self.hot_prefix_length + 1):
+            self._hot_prefix_cache.pop(key[:length], None)
     
 # test out the Trie
 if __name__ == '__main__':
-    df = pd.read_csv('./data/data.csv')
+    from pandas import read_csv # pd is only imported for type checking above
+    setup_logging()
+    df = read_csv('./data/data.csv')
     trie = Trie.from_list_of_names(df[['name', 'artists']])
     print(f'{trie.get_autocomplete_suggestions("lovesick") = }')